@@ -1,12 +1,3 @@
-# =========================
-# MATPLOTLIB
-# =========================
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-
 # =========================
 # FLASK CORE
 # =========================
@@ -20,12 +11,15 @@ from flask import (
     session,
     jsonify,
     send_file,
-    current_app
+    current_app,
+    g,
+    Response
 )
 
 # =========================
 # FLASK EXTENSIONS
 # =========================
+import click
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager,
@@ -38,6 +32,12 @@ from flask_login import (
 from flask_wtf.csrf import CSRFProtect
 from flask_mail import Mail, Message
 
+try:
+    from flask_sock import Sock    # serves /ws/ppg; /api/ppg/stream works without it
+except ImportError:
+    Sock = None
+    print("flask-sock not installed: /ws/ppg disabled, PPG streaming falls back to /api/ppg/stream")
+
 # =========================
 # SECURITY
 # =========================
@@ -49,12 +49,22 @@ import secrets
 # =========================
 # DATABASE / UTILITIES
 # =========================
+import io
 import os
+import json
 import uuid
-import requests
 import pytz
+import time
+import numpy as np
+import aqi_engine
+import upstream
+import gazetteer
+import ppg
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
 
 # =========================
 # FILE UPLOAD HELPERS
@@ -68,14 +78,9 @@ def allowed_file(filename):
     )
 
 # =========================
-# PDF (REPORTLAB)
+# PDF REPORTS (reportlab, see reports.py)
 # =========================
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import cm
-from reportlab.lib import colors
-from reportlab.platypus import Table, TableStyle, Paragraph
-from reportlab.lib.styles import getSampleStyleSheet
+import reports
 
 # =========================
 # ENV
@@ -189,10 +194,28 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # Shares one load with current_principal(), whichever runs first
+    principal = g.get("principal")
+    if principal is not None and principal.id == int(user_id):
+        return principal
+
+    user = db.session.get(User, int(user_id))
+    if session.get("user_id") == int(user_id):
+        g.principal = user
+    return user
 
 class HeartRateRecord(db.Model):
     __tablename__ = 'heart_rate_records'
+    __table_args__ = (
+        # Per-member history, newest first; bpm/aqi ride along for index-only scans
+        db.Index(
+            "ix_hr_user_member_created",
+            "user_id", "member_id", "created_at",
+            postgresql_include=["bpm", "aqi"]
+        ),
+        # Per-user history across members (coach views)
+        db.Index("ix_hr_user_created", "user_id", "created_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     
@@ -207,8 +230,36 @@ class HeartRateRecord(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
+# Raw readings are kept this long, then folded into daily rollups;
+# daily rollups older than HEART_RATE_DAILY_DAYS are folded into weekly ones
+app.config["HEART_RATE_RAW_DAYS"] = int(os.getenv("HEART_RATE_RAW_DAYS", 30))
+app.config["HEART_RATE_DAILY_DAYS"] = int(os.getenv("HEART_RATE_DAILY_DAYS", 180))
+
 AQICN_API_TOKEN = os.getenv("AQICN_API_TOKEN")
 
+# City -> lat/lon rarely changes, so geocodes are kept for a long time
+app.config["GEOCODE_CACHE_TTL"] = timedelta(days=int(os.getenv("GEOCODE_CACHE_TTL_DAYS", 90)))
+app.config["GEOCODE_LRU_SIZE"] = int(os.getenv("GEOCODE_LRU_SIZE", 1024))
+# Remotely geocoded places this close to a gazetteer city reuse its AQI entry
+app.config["GAZETTEER_SNAP_KM"] = float(os.getenv("GAZETTEER_SNAP_KM", 10))
+
+# WAQI station data updates about hourly; stale entries are served while refreshing
+app.config["AQI_CACHE_TTL"] = int(os.getenv("AQI_CACHE_TTL", 3600))
+app.config["AQI_CACHE_MAX_STALE"] = int(os.getenv("AQI_CACHE_MAX_STALE", 6 * 3600))
+app.config["AQI_CACHE_MAX_ENTRIES"] = int(os.getenv("AQI_CACHE_MAX_ENTRIES", 5000))
+
+# /api/aqi/batch fan-out
+app.config["AQI_BATCH_WORKERS"] = int(os.getenv("AQI_BATCH_WORKERS", 8))
+app.config["AQI_BATCH_MAX_CITIES"] = int(os.getenv("AQI_BATCH_MAX_CITIES", 25))
+
+# Prefetcher (flask prefetch-aqi): how often it runs and how hard it may hit WAQI
+app.config["AQI_PREFETCH_INTERVAL"] = int(os.getenv("AQI_PREFETCH_INTERVAL", 600))
+app.config["AQI_PREFETCH_WORKERS"] = int(os.getenv("AQI_PREFETCH_WORKERS", 4))
+app.config["AQI_PREFETCH_RATE_PER_MIN"] = int(os.getenv("AQI_PREFETCH_RATE_PER_MIN", 60))
+
+# Hourly city AQI series kept for /api/aqi/history
+app.config["AQI_HISTORY_DAYS"] = int(os.getenv("AQI_HISTORY_DAYS", 35))
+
 @csrf.exempt
 @app.route("/api/stress/save", methods=["POST"])
 def save_stress():
@@ -223,8 +274,6 @@ def save_stress():
     if member_id:
         member_id = int(member_id)
 
-    user = User.query.get(user_id)
-
     if not member_id:
         return jsonify({"error": "member_id required"}), 400
 
@@ -355,6 +404,21 @@ class User(UserMixin, db.Model):
     is_verified = db.Column(db.Boolean, default=False)
     selected_member_id = db.Column(db.Integer, db.ForeignKey("family_members.member_id"))
     profile_pic = db.Column(db.String(150), nullable=False, default='default.jpg')
+
+    # Case-insensitive prefix search for the coach roster (LIKE 'abc%');
+    # text_pattern_ops lets Postgres use them under any collation
+    __table_args__ = (
+        db.Index(
+            "ix_users_username_lower",
+            db.func.lower(username).label("username_lower"),
+            postgresql_ops={"username_lower": "text_pattern_ops"}
+        ),
+        db.Index(
+            "ix_users_email_lower",
+            db.func.lower(email).label("email_lower"),
+            postgresql_ops={"email_lower": "text_pattern_ops"}
+        ),
+    )
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -411,6 +475,9 @@ class FamilyMember(db.Model):
     
 class StressAssessment(db.Model):
     __tablename__ = "stress_assessment"
+    __table_args__ = (
+        db.Index("ix_stress_user_member_updated", "user_id", "member_id", "updated_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -431,6 +498,9 @@ class StressAssessment(db.Model):
 
 class CoachNote(db.Model):
     __tablename__ = "coach_notes"
+    __table_args__ = (
+        db.Index("ix_coach_notes_user_created", "user_id", "created_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     coach_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -441,6 +511,9 @@ class CoachNote(db.Model):
 
 class ConsultationRequest(db.Model):
     __tablename__ = "consultation_requests"
+    __table_args__ = (
+        db.Index("ix_consult_coach_created", "coach_id", "created_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -461,11 +534,287 @@ class Feedback(db.Model):
     message = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    
+
+class GeocodeCache(db.Model):
+    __tablename__ = "geocode_cache"
+
+    city_key = db.Column(db.String(100), primary_key=True)
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class CityAQI(db.Model):
+    __tablename__ = "city_aqi"
+
+    city_key = db.Column(db.String(100), primary_key=True)
+    aqi = db.Column(db.Integer)
+    pm25 = db.Column(db.Float)
+    pm10 = db.Column(db.Float)
+    dominant = db.Column(db.String(20))
+    refreshed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_payload(self):
+        return {
+            "aqi": self.aqi,
+            "pm25": self.pm25,
+            "pm10": self.pm10,
+            "dominant": self.dominant,
+        }
+
+
+class AQIHourly(db.Model):
+    __tablename__ = "aqi_hourly"
+
+    city_key = db.Column(db.String(100), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)   # UTC, truncated to the hour
+    samples = db.Column(db.Integer, nullable=False, default=0)
+    aqi = db.Column(db.Float)
+    pm25 = db.Column(db.Float)
+    pm10 = db.Column(db.Float)
+
+    def add_sample(self, payload):
+        """Fold one reading into the hour's running means."""
+        self.samples = (self.samples or 0) + 1
+        for field in ("aqi", "pm25", "pm10"):
+            value = payload.get(field)
+            if value is None:
+                continue
+            current = getattr(self, field)
+            setattr(self, field, value if current is None else current + (value - current) / self.samples)
+
+
+class HeartRateRollup(db.Model):
+    """
+    Compacted heart-rate history for one member over a day or a week.
+    Stores sums rather than means so rollups can be merged exactly.
+    """
+    __tablename__ = "heart_rate_rollups"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    member_id = db.Column(db.Integer, db.ForeignKey("family_members.member_id"), primary_key=True)
+    period = db.Column(db.String(4), primary_key=True)           # "day" | "week"
+    period_start = db.Column(db.DateTime, primary_key=True)      # UTC midnight (Monday for weeks)
+
+    count = db.Column(db.Integer, nullable=False, default=0)
+    bpm_min = db.Column(db.Integer)
+    bpm_max = db.Column(db.Integer)
+    bpm_sum = db.Column(db.Float, nullable=False, default=0.0)
+    bpm_sumsq = db.Column(db.Float, nullable=False, default=0.0)
+    aqi_sum = db.Column(db.Float, nullable=False, default=0.0)
+    aqi_count = db.Column(db.Integer, nullable=False, default=0)
+    pm25_sum = db.Column(db.Float, nullable=False, default=0.0)
+    pm25_count = db.Column(db.Integer, nullable=False, default=0)
+
+    SUM_FIELDS = ("count", "bpm_sum", "bpm_sumsq", "aqi_sum", "aqi_count", "pm25_sum", "pm25_count")
+
+    def merge(self, stats):
+        """Fold another rollup (or a stats dict with the same fields) into this one."""
+        get = stats.get if isinstance(stats, dict) else lambda f: getattr(stats, f)
+        for field in self.SUM_FIELDS:
+            setattr(self, field, (getattr(self, field) or 0) + get(field))
+        lo, hi = get("bpm_min"), get("bpm_max")
+        self.bpm_min = lo if self.bpm_min is None else min(self.bpm_min, lo)
+        self.bpm_max = hi if self.bpm_max is None else max(self.bpm_max, hi)
+
+    def to_point(self):
+        return rollup_point(self.period, self.period_start, {
+            field: getattr(self, field) for field in self.SUM_FIELDS + ("bpm_min", "bpm_max")
+        })
+
+
 with app.app_context():
     db.create_all()
 
 
+# =========================
+# REQUEST PRINCIPAL
+# =========================
+
+def current_principal():
+    """The logged-in User for this request, loaded at most once and kept on g."""
+    if "principal" not in g:
+        user_id = session.get("user_id")
+        g.principal = db.session.get(User, user_id) if user_id else None
+    return g.principal
+
+
+def requires_role(*roles, api=False):
+    """
+    Guard a route with the request principal: logged in, and (if `roles`
+    are given) holding one of them. Page routes redirect to login/index;
+    api=True routes answer 401/403 JSON instead.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            user = current_principal()
+
+            if user is None:
+                if api:
+                    return jsonify({"error": "Unauthorized"}), 401
+                return redirect(url_for("login"))
+
+            if roles and user.role not in roles:
+                if api:
+                    return jsonify({"error": "Forbidden"}), 403
+                return redirect(url_for("index"))
+
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# =========================
+# HOT READ QUERIES
+# =========================
+# Each one is served by a composite index declared on its model;
+# `flask check-query-plans` fails if any of them falls back to a table scan.
+
+def member_heart_rates(user_id, member_id):
+    """A member's readings, newest first."""
+    return HeartRateRecord.query.filter_by(
+        user_id=user_id,
+        member_id=member_id
+    ).order_by(HeartRateRecord.created_at.desc())
+
+
+def user_heart_rates(user_id):
+    """All of a user's readings across members, newest first."""
+    return HeartRateRecord.query.filter_by(
+        user_id=user_id
+    ).order_by(HeartRateRecord.created_at.desc())
+
+
+def member_stress(user_id, member_id):
+    """A member's stress assessments, newest first."""
+    return StressAssessment.query.filter_by(
+        user_id=user_id,
+        member_id=member_id
+    ).order_by(StressAssessment.updated_at.desc())
+
+
+def coach_notes_for(user_id):
+    """Coach notes left for a user, newest first."""
+    return CoachNote.query.filter_by(
+        user_id=user_id
+    ).order_by(CoachNote.created_at.desc())
+
+
+def consultation_requests_for(coach_id):
+    """Consultation requests addressed to a coach, newest first."""
+    return ConsultationRequest.query.filter_by(
+        coach_id=coach_id
+    ).order_by(ConsultationRequest.created_at.desc())
+
+
+# Keyset pagination: ?before=<created_at ISO>,<id>&limit=N over
+# (created_at DESC, id DESC); the next page's cursor is sent in X-Next-Cursor.
+# Every response is one page, so its cost does not grow with history length
+PAGE_LIMIT_DEFAULT = 50
+PAGE_LIMIT_MAX = 200
+
+
+def page_args():
+    """(before, limit) from the query string; raises ValueError on a bad cursor."""
+    before = request.args.get("before")
+    limit = min(max(request.args.get("limit", PAGE_LIMIT_DEFAULT, type=int), 1), PAGE_LIMIT_MAX)
+
+    if not before:
+        return None, limit
+
+    stamp, _, row_id = before.rpartition(",")
+    return (datetime.fromisoformat(stamp), int(row_id)), limit
+
+
+def keyset_page(query, created_col, id_col, before, limit):
+    """
+    Rows of `query` (already ordered newest first) after the `before` cursor,
+    plus the cursor for the page after them (None on the last page).
+    """
+    if before:
+        query = query.filter(db.tuple_(created_col, id_col) < before)
+
+    rows = query.order_by(id_col.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    if not isinstance(last, db.Model):     # row of (entity, extra columns...)
+        last = last[0]
+    return rows, f"{getattr(last, created_col.key).isoformat()},{getattr(last, id_col.key)}"
+
+
+def paged_json(items, next_cursor):
+    resp = jsonify(items)
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp
+
+
+HOT_READ_QUERIES = {
+    "member_heart_rates": lambda: member_heart_rates(1, 1).limit(7),
+    "member_heart_rate_count": lambda: member_heart_rates(1, 1).order_by(None).with_entities(db.func.count()),
+    "user_heart_rates": lambda: user_heart_rates(1).limit(7),
+    "member_stress": lambda: member_stress(1, 1).limit(1),
+    "coach_notes_for": lambda: coach_notes_for(1),
+    "consultation_requests_for": lambda: consultation_requests_for(1),
+}
+
+
+@app.cli.command("create-indexes")
+def create_indexes_command():
+    """Create declared indexes that are missing on existing tables."""
+    # create_all() skips tables that already exist, and with them their new indexes
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    print("INDEXES: up to date")
+
+
+def explain_query(query):
+    """Plan lines for a Query, as reported by the current database."""
+    sql = str(query.statement.compile(
+        dialect=db.engine.dialect,
+        compile_kwargs={"literal_binds": True}
+    ))
+
+    if db.engine.dialect.name == "postgresql":
+        # Tiny tables make a seq scan genuinely cheaper; only fall back to
+        # one when there is no usable index at all
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        lines = [row[0] for row in db.session.execute(text("EXPLAIN " + sql))]
+        db.session.rollback()
+        return lines
+
+    return [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql))]
+
+
+def is_table_scan(plan_line):
+    line = plan_line.strip().lstrip("-> ")
+    # Postgres: "Seq Scan on t", SQLite: "SCAN t" (index use reads "SEARCH t USING INDEX")
+    return line.startswith("Seq Scan") or (line.startswith("SCAN ") and "USING" not in line)
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """EXPLAIN the hot read queries; exit non-zero if any scans a whole table."""
+    failed = []
+
+    for name, build in HOT_READ_QUERIES.items():
+        plan = explain_query(build())
+        scans = [line for line in plan if is_table_scan(line)]
+        print(("FAIL " if scans else "ok   ") + name)
+        for line in plan:
+            print("     ", line)
+        if scans:
+            failed.append(name)
+
+    if failed:
+        raise click.ClickException("table scans in: " + ", ".join(failed))
+
+
 # --- GET Details for Selected Member (API) ---
 @app.route('/api/member/<int:id_val>')
 @login_required
@@ -547,8 +896,7 @@ def feedback():
         flash("Please login to submit feedback.", "warning")
         return redirect(url_for('login'))
 
-    # ✅ Get user using SQLAlchemy
-    user = User.query.get(session["user_id"])
+    user = current_principal()
 
     if not user:
         flash("User not found.", "danger")
@@ -590,15 +938,8 @@ def last_health_summary():
         return jsonify({"error": "member_id required"}), 400
         
 
-    # STEP 2: Build query
-    query = HeartRateRecord.query.filter_by(user_id=user_id)
-
-    if selected_member:
-        query = query.filter_by(member_id=selected_member)
-
-
-    # STEP 3: Get latest record
-    record = query.order_by(HeartRateRecord.created_at.desc()).first()
+    # STEP 2: Get latest record
+    record = member_heart_rates(user_id, selected_member).first()
 
     if not record:
         return jsonify({"exists": False})
@@ -617,12 +958,12 @@ def last_health_summary_member():
 
     member_id = request.args.get("member_id", type=int)
 
-    query = HeartRateRecord.query.filter_by(user_id=session["user_id"])
-
     if member_id:
-        query = query.filter_by(member_id=member_id)
+        query = member_heart_rates(session["user_id"], member_id)
+    else:
+        query = user_heart_rates(session["user_id"])
 
-    record = query.order_by(HeartRateRecord.created_at.desc()).first()
+    record = query.first()
     if not record:
         return jsonify({"exists": False})
 
@@ -688,65 +1029,120 @@ def submit_consultation():
 
 @app.route("/api/coach/requests")
 def coach_requests():
+    """Requests to the coach, newest first; ?patient_id= narrows to one patient."""
     if "user_id" not in session:
         return jsonify([])
 
-    requests_list = (
-        ConsultationRequest.query
-        .filter_by(coach_id=session["user_id"])
-        .order_by(ConsultationRequest.created_at.desc())
-        .all()
+    try:
+        before, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    query = consultation_requests_for(session["user_id"])
+    patient_id = request.args.get("patient_id", type=int)
+    if patient_id:
+        query = query.filter(ConsultationRequest.user_id == patient_id)
+
+    rows, next_cursor = keyset_page(
+        query
+        .outerjoin(User, User.id == ConsultationRequest.user_id)
+        .add_columns(User.username),
+        ConsultationRequest.created_at, ConsultationRequest.id,
+        before, limit
     )
 
     result = []
-    for r in requests_list:
-        user = User.query.get(r.user_id)
+    for r, username in rows:
         result.append({
             "id": r.id,
             "patient_id": r.user_id,
-            "patient": user.username if user else "Unknown",
+            "patient": username or "Unknown",
             "reason": r.reason,
             "details": r.details,
             "created_at": r.created_at.isoformat()
         })
 
-    return jsonify(result)
+    return paged_json(result, next_cursor)
 
 @app.route("/api/telehealth/user-snapshot/<int:user_id>")
+@requires_role("coach", api=True)
 def telehealth_user_snapshot(user_id):
-    if "user_id" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
-
-    coach = User.query.get(session["user_id"])
-    if not coach or coach.role != "coach":
-        return jsonify({"error": "Forbidden"}), 403
-
-    user = User.query.get(user_id)
-
-
-    hr_rows = HeartRateRecord.query.filter_by(user_id=user_id).limit(50).all()
+    member_id = request.args.get("member_id", type=int)
+    days = min(max(request.args.get("days", 30, type=int), 1), 365)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+    since = datetime.utcnow() - timedelta(days=days)
 
+    if member_id:
+        readings = member_heart_rates(user_id, member_id)
+    else:
+        readings = user_heart_rates(user_id)
+    readings = readings.filter(HeartRateRecord.created_at >= since)
+
+    # 1) username + aggregates of the raw readings in the range in one statement
+    username = (
+        db.session.query(User.username)
+        .filter(User.id == user_id)
+        .scalar_subquery()
+    )
+    summary = readings.order_by(None).with_entities(
+        username.label("username"),
+        db.func.count(HeartRateRecord.id).label("count"),
+        db.func.sum(HeartRateRecord.bpm).label("sum"),
+        db.func.min(HeartRateRecord.bpm).label("min"),
+        db.func.max(HeartRateRecord.bpm).label("max")
+    ).one()
+
+    # Readings older than HEART_RATE_RAW_DAYS only survive as rollups; those
+    # overlapping the range count in full (the range widens to whole periods)
+    rollups = HeartRateRollup.query.filter(
+        HeartRateRollup.user_id == user_id,
+        db.or_(
+            db.and_(HeartRateRollup.period == "day", HeartRateRollup.period_start > since - timedelta(days=1)),
+            db.and_(HeartRateRollup.period == "week", HeartRateRollup.period_start > since - timedelta(days=7))
+        )
+    )
+    if member_id:
+        rollups = rollups.filter(HeartRateRollup.member_id == member_id)
+    rolled = rollups.with_entities(
+        db.func.sum(HeartRateRollup.count).label("count"),
+        db.func.sum(HeartRateRollup.bpm_sum).label("sum"),
+        db.func.min(HeartRateRollup.bpm_min).label("min"),
+        db.func.max(HeartRateRollup.bpm_max).label("max")
+    ).one()
+
+    count = summary.count + (rolled.count or 0)
+    lows = [v for v in (summary.min, rolled.min) if v is not None]
+    highs = [v for v in (summary.max, rolled.max) if v is not None]
+
+    # 2) newest `limit` raw readings of the range, returned oldest first
+    hr_rows = readings.with_entities(
+        HeartRateRecord.bpm,
+        HeartRateRecord.created_at
+    ).limit(limit).all()
 
-    user = User.query.get(user_id)
-    
-    stress = StressAssessment.query.filter_by(
-        user_id=user_id,
-        member_id=request.args.get("member_id", type=int)
-    ).first()
-    
-    bpm_values = [r.bpm for r in hr_rows]
+    if member_id:
+        stress = member_stress(user_id, member_id).first()
+    else:
+        stress = (
+            StressAssessment.query
+            .filter_by(user_id=user_id)
+            .order_by(StressAssessment.updated_at.desc())
+            .first()
+        )
 
     return jsonify({
-        "username": user.username if user else "Unknown",
+        "username": summary.username or "Unknown",
+        "range_days": days,
         "heart_rate": {
-            "avg": round(sum(bpm_values)/len(bpm_values)) if bpm_values else None,
-            "max": max(bpm_values) if bpm_values else None,
-            "min": min(bpm_values) if bpm_values else None,
+            "count": count,
+            "avg": round(((summary.sum or 0) + (rolled.sum or 0)) / count) if count else None,
+            "max": max(highs) if highs else None,
+            "min": min(lows) if lows else None,
             "history": [
                 {
                     "bpm": r.bpm,
                     "time": r.created_at.strftime("%d %b %Y %I:%M %p")
-                } for r in hr_rows[::-1]
+                } for r in reversed(hr_rows)
             ]
         },
         "stress": {
@@ -814,12 +1210,7 @@ def telehealth_coach_response():
     if "user_id" not in session:
         return jsonify({"note": None}), 401
 
-    note = (
-        CoachNote.query
-        .filter_by(user_id=session["user_id"])
-        .order_by(CoachNote.created_at.desc())
-        .first()
-    )
+    note = coach_notes_for(session["user_id"]).first()
 
     if not note:
         return jsonify({"note": None})
@@ -888,26 +1279,31 @@ def telehealth_coach_timeline():
     if "user_id" not in session:
         return jsonify([]), 401
 
-    notes = (
-        CoachNote.query
-        .filter_by(user_id=session["user_id"])
-        .order_by(CoachNote.created_at.desc())
-        .all()
+    try:
+        before, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    rows, next_cursor = keyset_page(
+        coach_notes_for(session["user_id"])
+        .outerjoin(User, User.id == CoachNote.coach_id)
+        .add_columns(User.username, User.email),
+        CoachNote.created_at, CoachNote.id,
+        before, limit
     )
 
     timeline = []
-    for n in notes:
-        coach = User.query.get(n.coach_id)
+    for n, coach_name, coach_email in rows:
         timeline.append({
             "id": n.id,
             "note": n.note,
-            "coach_name": coach.username if coach else "",
-            "coach_email": coach.email if coach else "",
+            "coach_name": coach_name or "",
+            "coach_email": coach_email or "",
             "timestamp": n.created_at.isoformat(),
             "seen": n.seen
         })
 
-    return jsonify(timeline)
+    return paged_json(timeline, next_cursor)
 
 
 @csrf.exempt
@@ -991,12 +1387,7 @@ def get_latest_stress():
     if not member_id:
         return jsonify({"error": "member_id required"}), 400
 
-    query = StressAssessment.query.filter_by(
-        user_id=session["user_id"],
-        member_id=member_id
-    )
-
-    stress = query.order_by(StressAssessment.updated_at.desc()).first()
+    stress = member_stress(session["user_id"], member_id).first()
 
     if not stress:
         return jsonify({})
@@ -1046,55 +1437,203 @@ def telehealth():
 
 
 @app.route("/coach/dashboard")
+@requires_role("coach")
 def coach_dashboard():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    # ✅ Fetch coach using SQLAlchemy
-    coach = User.query.get(session["user_id"])
-
-    if not coach or coach.role != "coach":
-        return redirect(url_for("index"))
+    coach = current_principal()
 
     if coach.verification_status != "approved":
         return redirect(url_for("coach_pending"))
 
-    patients = User.query.filter_by(role="user").order_by(User.id.desc()).all()
-
-    selected_patient = patients[0] if patients else None
-
-    metrics = None
-    notes = []
-
-    if selected_patient:
-        notes = CoachNote.query.filter_by(user_id=selected_patient.id).order_by(CoachNote.created_at.desc()).all()
+    # First roster page only; the rest is loaded from /api/coach/patients
+    patients, next_cursor = patient_roster_page(coach.id, limit=ROSTER_PAGE_SIZE)
 
     return render_template(
         "dashboard/coach_dashboard.html",
         coach=coach,
         patients=patients,
-        selected_patient=selected_patient,
-        metrics=metrics,
-        notes=notes
+        next_cursor=next_cursor
     )
 
-@app.route("/api/coach/patient/<int:user_id>/last-7")
-def coach_last_7_hr(user_id):
-    if "user_id" not in session:
-        return jsonify([]), 401
 
-    coach = User.query.get(session["user_id"])
-    if not coach or coach.role != "coach":
-        return jsonify([]), 403
+ROSTER_PAGE_SIZE = 25
 
-    records = (
-        HeartRateRecord.query
-        .filter_by(user_id=user_id)
-        .order_by(HeartRateRecord.created_at.desc())
-        .limit(7)
+
+def coach_patient(coach_id):
+    """SQL condition: User is one of this coach's patients (has sent them a consultation request)."""
+    return db.exists().where(
+        ConsultationRequest.user_id == User.id,
+        ConsultationRequest.coach_id == coach_id
+    )
+
+
+def patient_roster_page(coach_id, search=None, before=None, limit=ROSTER_PAGE_SIZE):
+    """
+    One page of this coach's patients, newest accounts first, as (id,) rows.
+    `search` is a case-insensitive prefix of the username or email, or a
+    patient number ("Patient-0007" or "7"); `before` is the last id of the
+    previous page. Only the coach's own patients are ever searched.
+    """
+    query = db.session.query(User.id).filter(User.role == "user", coach_patient(coach_id))
+
+    if search:
+        pattern = search.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        matches = [
+            db.func.lower(User.username).like(pattern, escape="\\"),
+            db.func.lower(User.email).like(pattern, escape="\\")
+        ]
+        number = search.lower().removeprefix("patient-")
+        if number.isdigit():
+            matches.append(User.id == int(number))
+        query = query.filter(db.or_(*matches))
+
+    if before:
+        query = query.filter(User.id < before)
+
+    rows = query.order_by(User.id.desc()).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    return rows[:limit], str(rows[limit - 1].id)
+
+
+@app.route("/api/coach/patients")
+@requires_role("coach", api=True)
+def coach_patients():
+    """Roster page: /api/coach/patients?q=<prefix or patient no.>&before=<id>&limit=N"""
+    search = (request.args.get("q") or "").strip()[:100]
+    before = request.args.get("before", type=int)
+    limit = min(max(request.args.get("limit", ROSTER_PAGE_SIZE, type=int), 1), PAGE_LIMIT_MAX)
+
+    rows, next_cursor = patient_roster_page(current_principal().id, search, before, limit)
+
+    return paged_json([{"id": r.id} for r in rows], next_cursor)
+
+OVERVIEW_TREND_READINGS = 7
+
+
+def coach_overview(coach_id, patients):
+    """
+    Latest vitals for a page of patient id rows, in four
+    queries however many patients there are: recent readings and latest
+    stress via ROW_NUMBER() windows, unseen notes and last consultation
+    via GROUP BY.
+    """
+    ids = [p.id for p in patients]
+    if not ids:
+        return []
+
+    # --- last N readings per patient ---
+    hr_rank = db.func.row_number().over(
+        partition_by=HeartRateRecord.user_id,
+        order_by=(HeartRateRecord.created_at.desc(), HeartRateRecord.id.desc())
+    ).label("rank")
+    recent = (
+        db.session.query(HeartRateRecord.user_id, HeartRateRecord.bpm, HeartRateRecord.created_at, hr_rank)
+        .filter(HeartRateRecord.user_id.in_(ids))
+        .subquery()
+    )
+    readings = (
+        db.session.query(recent.c.user_id, recent.c.rank, recent.c.bpm, recent.c.created_at)
+        .filter(recent.c.rank <= OVERVIEW_TREND_READINGS)
+        .all()
+    )
+
+    # --- latest stress assessment per patient ---
+    stress_rank = db.func.row_number().over(
+        partition_by=StressAssessment.user_id,
+        order_by=(StressAssessment.updated_at.desc(), StressAssessment.id.desc())
+    ).label("rank")
+    ranked_stress = (
+        db.session.query(StressAssessment.user_id, StressAssessment.total_score,
+                         StressAssessment.stress_level, stress_rank)
+        .filter(StressAssessment.user_id.in_(ids))
+        .subquery()
+    )
+    stress = {
+        r.user_id: r for r in
+        db.session.query(ranked_stress).filter(ranked_stress.c.rank == 1)
+    }
+
+    # --- this coach's unseen notes and latest consultation per patient ---
+    unseen = dict(
+        db.session.query(CoachNote.user_id, db.func.count(CoachNote.id))
+        .filter(
+            CoachNote.user_id.in_(ids),
+            CoachNote.coach_id == coach_id,
+            db.or_(CoachNote.seen.is_(False), CoachNote.seen.is_(None))
+        )
+        .group_by(CoachNote.user_id)
+        .all()
+    )
+    last_consult = dict(
+        db.session.query(ConsultationRequest.user_id, db.func.max(ConsultationRequest.created_at))
+        .filter(ConsultationRequest.user_id.in_(ids), ConsultationRequest.coach_id == coach_id)
+        .group_by(ConsultationRequest.user_id)
         .all()
     )
 
+    latest, slope = {}, {}
+    if readings:
+        user, rank, bpm, created = zip(*readings)
+        user = np.array(user)
+        rank = np.array(rank)
+        bpm = np.array(bpm, dtype=float)
+
+        for uid, b, c in zip(user[rank == 1], bpm[rank == 1], np.array(created, dtype=object)[rank == 1]):
+            latest[int(uid)] = (int(b), c)
+
+        # Least-squares slope of BPM over reading order (oldest = 0), per patient
+        keys, group = np.unique(user, return_inverse=True)
+        n = np.bincount(group)
+        x = (n[group] - rank).astype(float)
+        x_mean = np.bincount(group, x) / n
+        y_mean = np.bincount(group, bpm) / n
+        dx = x - x_mean[group]
+        sxx = np.bincount(group, dx * dx)
+        sxy = np.bincount(group, dx * (bpm - y_mean[group]))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            per_reading = np.where(n >= 2, sxy / sxx, np.nan)
+        slope = {int(k): float(v) for k, v in zip(keys, per_reading) if not np.isnan(v)}
+
+    result = []
+    for p in patients:
+        bpm_at = latest.get(p.id)
+        s = stress.get(p.id)
+        consulted = last_consult.get(p.id)
+        result.append({
+            "id": p.id,
+            "latest_bpm": bpm_at[0] if bpm_at else None,
+            "latest_bpm_at": bpm_at[1].isoformat() if bpm_at else None,
+            "trend_slope": round(slope[p.id], 2) if p.id in slope else None,
+            "stress_score": s.total_score if s else None,
+            "stress_level": s.stress_level if s else None,
+            "unseen_notes": unseen.get(p.id, 0),
+            "last_consultation": consulted.isoformat() if consulted else None
+        })
+    return result
+
+
+@app.route("/api/coach/overview")
+@requires_role("coach", api=True)
+def coach_overview_api():
+    """
+    Roster page with per-patient vitals:
+    /api/coach/overview?q=<prefix>&before=<id>&limit=N (same paging as /api/coach/patients)
+    trend_slope is BPM change per reading over the last 7 readings.
+    """
+    coach = current_principal()
+    search = (request.args.get("q") or "").strip()[:100]
+    before = request.args.get("before", type=int)
+    limit = min(max(request.args.get("limit", ROSTER_PAGE_SIZE, type=int), 1), PAGE_LIMIT_MAX)
+
+    patients, next_cursor = patient_roster_page(coach.id, search, before, limit)
+    return paged_json(coach_overview(coach.id, patients), next_cursor)
+
+
+@app.route("/api/coach/patient/<int:user_id>/last-7")
+@requires_role("coach", api=True)
+def coach_last_7_hr(user_id):
+    records = user_heart_rates(user_id).limit(7).all()
+
     return jsonify([
         {"bpm": r.bpm, "time": r.created_at.isoformat()}
         for r in records
@@ -1136,7 +1675,7 @@ def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    user = db.session.get(User, session['user_id'])
+    user = current_principal()
     db.session.refresh(user)  
 
     from sqlalchemy import case
@@ -1163,398 +1702,1580 @@ def tracker():
         return redirect(url_for('login'))
     return render_template('features/tracker.html')
 
-@csrf.exempt
-@app.route('/save-heart-rate', methods=['POST'])
-def save_heart_rate():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
+# =========================
+# HEART RATE ROLLUPS
+# =========================
 
-    data = request.get_json(force=True) or {}
+def _utc_midnight(dt):
+    return datetime(dt.year, dt.month, dt.day)
 
-    def safe_int(x, default=0):
-        try: return int(float(x))
-        except: return default
 
-    def safe_float(x, default=0.0):
-        try: return float(x)
-        except: return default
+def summarize_readings(rows):
+    """
+    Per-day stats for (created_at, bpm, aqi, pm25) rows, keyed by UTC midnight.
+    AQI/PM2.5 of 0 mean "no reading" (see save_heart_rate) and are not averaged.
+    """
+    if not rows:
+        return {}
 
-    # ===== MEMBER ID STRICT =====
-    raw_member_id = data.get("member_id")
-    if not raw_member_id:
-        return jsonify({"error": "member_id required"}), 400
+    created, bpm, aqi, pm25 = zip(*rows)
+    days, bucket = np.unique(
+        np.array(created, dtype="datetime64[us]").astype("datetime64[D]"),
+        return_inverse=True
+    )
+    n = len(days)
+
+    bpm = np.array(bpm, dtype=float)
+    aqi = np.array([v or 0 for v in aqi], dtype=float)
+    pm25 = np.array([v or 0 for v in pm25], dtype=float)
+
+    bpm_min = np.full(n, np.inf)
+    bpm_max = np.full(n, -np.inf)
+    np.minimum.at(bpm_min, bucket, bpm)
+    np.maximum.at(bpm_max, bucket, bpm)
+
+    stats = {
+        "count": np.bincount(bucket, minlength=n),
+        "bpm_sum": np.bincount(bucket, bpm, n),
+        "bpm_sumsq": np.bincount(bucket, bpm * bpm, n),
+        "bpm_min": bpm_min,
+        "bpm_max": bpm_max,
+    }
+    for field, values in (("aqi", aqi), ("pm25", pm25)):
+        has = values > 0
+        stats[field + "_sum"] = np.bincount(bucket[has], values[has], n)
+        stats[field + "_count"] = np.bincount(bucket[has], minlength=n)
+
+    summary = {}
+    for i, day in enumerate(days.astype(datetime)):
+        summary[_utc_midnight(day)] = {
+            field: (int(v[i]) if field in ("count", "aqi_count", "pm25_count", "bpm_min", "bpm_max")
+                    else float(v[i]))
+            for field, v in stats.items()
+        }
+    return summary
 
-    try:
-        member_id = int(raw_member_id)
-    except:
-        return jsonify({"error": "Invalid member_id"}), 400
 
-    member = FamilyMember.query.filter_by(
-        member_id=member_id,
-        user_id=session["user_id"]
-    ).first()
-    if not member:
-        return jsonify({"error": "Invalid member"}), 400
+def rollup_point(period, start, stats):
+    """JSON point for /api/heart-rate/history from rollup-style sums."""
+    n = stats["count"]
+    mean = stats["bpm_sum"] / n
+    variance = max(0.0, stats["bpm_sumsq"] / n - mean * mean)
+    return {
+        "period": period,
+        "start": start.isoformat() + "Z",
+        "count": n,
+        "mean": round(mean, 1),
+        "min": stats["bpm_min"],
+        "max": stats["bpm_max"],
+        "stddev": round(variance ** 0.5, 1),
+        "aqi": round(stats["aqi_sum"] / stats["aqi_count"], 1) if stats["aqi_count"] else None,
+        "pm25": round(stats["pm25_sum"] / stats["pm25_count"], 1) if stats["pm25_count"] else None,
+    }
 
-    incoming_bpm = safe_int(data.get("bpm"))
 
-    # ===== DELETE OLDEST IF > 7 =====
-    count = HeartRateRecord.query.filter_by(
-        user_id=session["user_id"],
-        member_id=member_id
-    ).count()
+def _merge_rollup(user_id, member_id, period, start, stats):
+    rollup = db.session.get(HeartRateRollup, (user_id, member_id, period, start))
+    if rollup is None:
+        rollup = HeartRateRollup(user_id=user_id, member_id=member_id, period=period, period_start=start)
+        db.session.add(rollup)
+    rollup.merge(stats)
 
-    if count >= 7:
-        oldest = HeartRateRecord.query.filter_by(
-            user_id=session["user_id"],
-            member_id=member_id
-        ).order_by(HeartRateRecord.created_at.asc(), HeartRateRecord.id.asc()).first()
-        db.session.delete(oldest)
-        db.session.commit()
 
-    # ===== SAVE NEW RECORD ONLY =====
-    record = HeartRateRecord(
-        user_id=session["user_id"],
-        member_id=member_id,
-        bpm=incoming_bpm,
-        aqi=safe_int(data.get("aqi")),
-        pm25=safe_float(data.get("pm25")),
-        pm10=safe_float(data.get("pm10")),
-        stress_level=data.get("stress"),
-        impact_category=data.get("impact")
-    )
+def compact_heart_rates(user_id, member_id, now=None):
+    """
+    Fold a member's raw readings older than HEART_RATE_RAW_DAYS into daily
+    rollups, and daily rollups older than HEART_RATE_DAILY_DAYS into weekly
+    ones. Only whole days/weeks are compacted. Does not commit.
+    """
+    now = now or datetime.utcnow()
+    day_cutoff = _utc_midnight(now - timedelta(days=app.config["HEART_RATE_RAW_DAYS"]))
+    week_cutoff = _utc_midnight(now - timedelta(days=app.config["HEART_RATE_DAILY_DAYS"]))
+    week_cutoff -= timedelta(days=week_cutoff.weekday())
 
-    db.session.add(record)
-    db.session.commit()
+    old = member_heart_rates(user_id, member_id).filter(HeartRateRecord.created_at < day_cutoff)
+    rows = old.with_entities(
+        HeartRateRecord.created_at,
+        HeartRateRecord.bpm,
+        HeartRateRecord.aqi,
+        HeartRateRecord.pm25
+    ).all()
 
-    print("SAVED:", 
-          "user_id:", session["user_id"], 
-          "member_id:", member_id, 
-          "bpm:", incoming_bpm)
+    if rows:
+        for day, stats in summarize_readings(rows).items():
+            _merge_rollup(user_id, member_id, "day", day, stats)
+        old.order_by(None).delete(synchronize_session=False)
 
-    return jsonify({"success": True})
+    db.session.flush()
 
+    old_days = HeartRateRollup.query.filter(
+        HeartRateRollup.user_id == user_id,
+        HeartRateRollup.member_id == member_id,
+        HeartRateRollup.period == "day",
+        HeartRateRollup.period_start < week_cutoff
+    ).all()
 
-def calculate_us_aqi(pm25):
-    """Calculates US EPA AQI from PM2.5 concentration"""
-    if pm25 is None: return None
-    try:
-        c = float(pm25)
-        if c < 0: return 0
-        if c <= 12.0: return round(((50 - 0) / (12.0 - 0)) * (c - 0) + 0)
-        if c <= 35.4: return round(((100 - 51) / (35.4 - 12.1)) * (c - 12.1) + 51)
-        if c <= 55.4: return round(((150 - 101) / (55.4 - 35.5)) * (c - 35.5) + 101)
-        if c <= 150.4: return round(((200 - 151) / (150.4 - 55.5)) * (c - 55.5) + 151)
-        if c <= 250.4: return round(((300 - 201) / (250.4 - 150.5)) * (c - 150.5) + 201)
-        if c <= 350.4: return round(((400 - 301) / (350.4 - 250.5)) * (c - 250.5) + 301)
-        if c <= 500.4: return round(((500 - 401) / (500.4 - 350.5)) * (c - 350.5) + 401)
-        return 500
-    except (ValueError, TypeError):
-        return None
+    for daily in old_days:
+        monday = daily.period_start - timedelta(days=daily.period_start.weekday())
+        _merge_rollup(user_id, member_id, "week", monday, daily)
+        db.session.delete(daily)
 
-@csrf.exempt
-@app.route("/api/aqi")
-def get_aqi():
-    city = request.args.get("city")
-    if not city:
-        return jsonify({"error": "City required"}), 400
+    return len(rows) + len(old_days)
 
-    if not AQICN_API_TOKEN:
-        return jsonify({"error": "AQICN token missing"}), 500
 
-    try:
-        geo_resp = requests.get(
-            "https://nominatim.openstreetmap.org/search",
-            params={"q": city, "format": "json", "limit": 1},
-            headers={"User-Agent": "HridyaCare/1.0"},
-            timeout=10
-        ).json()
-    except Exception:
-        return jsonify({"error": "Geocoding failed"}), 502
+def safe_int(x, default=0):
+    try: return int(float(x))
+    except: return default
 
-    if not geo_resp:
-        return jsonify({"error": "City not found"}), 404
 
-    lat = geo_resp[0]["lat"]
-    lon = geo_resp[0]["lon"]
+def safe_float(x, default=0.0):
+    try: return float(x)
+    except: return default
 
-    url = f"https://api.waqi.info/feed/geo:{lat};{lon}/"
-    params = {"token": AQICN_API_TOKEN}
 
-    try:
-        resp = requests.get(url, params=params, timeout=10).json()
-    except Exception:
-        return jsonify({"error": "AQI API unreachable"}), 502
+from sqlalchemy import event
 
-    if resp.get("status") != "ok":
-        return jsonify({"error": "AQICN error", "details": resp}), 502
 
-    data = resp["data"]
+# Members this process has compacted on the current UTC day. Only today's
+# set is kept, and a member is added only once its transaction commits.
+_compacted_today = {"day": None, "members": set()}
+_compacted_lock = threading.Lock()
 
-    # ----------------------------------------------
-    # 🚨 THE FIX: FORCE CALCULATION
-    # ----------------------------------------------
-    raw_aqi = data["aqi"]
-    pm25_val = data.get("iaqi", {}).get("pm25", {}).get("v")
-    pm10_val = data.get("iaqi", {}).get("pm10", {}).get("v")
 
+@event.listens_for(db.session, "after_commit")
+def _record_compactions(session):
+    done = session.info.pop("compacted_members", None)
+    if not done:
+        return
+    with _compacted_lock:
+        for member_id, day in done:
+            if _compacted_today["day"] is None or day > _compacted_today["day"]:
+                _compacted_today["day"] = day
+                _compacted_today["members"] = set()
+            if day == _compacted_today["day"]:
+                _compacted_today["members"].add(member_id)
 
-    calculated_aqi = calculate_us_aqi(pm25_val)
 
-    final_aqi = calculated_aqi if calculated_aqi is not None else raw_aqi
+@event.listens_for(db.session, "after_rollback")
+def _forget_compactions(session):
+    session.info.pop("compacted_members", None)
 
-    print(f"City: {city} | API Says: {raw_aqi} | PM2.5: {pm25_val} | Calculated: {final_aqi}")
-    pm25_val = data.get("iaqi", {}).get("pm25", {}).get("v")
-    pm10_val = data.get("iaqi", {}).get("pm10", {}).get("v")
 
-    return jsonify({
-        "city": city,
-        "aqi": final_aqi,  
-        "pm25": pm25_val,
-        "pm10": pm10_val,
-        "dominant": data.get("dominentpol"),
+def compact_if_due(user_id, member_id, now, oldest=None):
+    """
+    Compact on a member's first save of the (UTC) day in this process, or
+    when a backdated reading (`oldest`) is already past the raw cutoff;
+    other saves skip the extra queries and `flask compact-heart-rates`
+    catches the rest. Callers hold the member's row lock.
+    """
+    today = now.date()
+    cutoff = _utc_midnight(now - timedelta(days=app.config["HEART_RATE_RAW_DAYS"]))
+
+    with _compacted_lock:
+        done = _compacted_today["day"] == today and member_id in _compacted_today["members"]
+    if done and (oldest is None or oldest >= cutoff):
+        return 0
+
+    compacted = compact_heart_rates(user_id, member_id, now)
+    db.session.info.setdefault("compacted_members", []).append((member_id, today))
+    return compacted
+
+
+def append_heart_rate(record):
+    """
+    Add `record` and compact its member's expired history when due, all in
+    the caller's transaction. Callers lock the member row first so
+    concurrent saves cannot fold the same readings twice.
+    """
+    db.session.add(record)
+    db.session.flush()
+    compact_if_due(record.user_id, record.member_id, datetime.utcnow(), record.created_at)
+
+
+@app.cli.command("compact-heart-rates")
+def compact_heart_rates_command():
+    """Roll up expired heart-rate history for every member."""
+    members = (
+        db.session.query(HeartRateRecord.user_id, HeartRateRecord.member_id)
+        .filter(HeartRateRecord.member_id.isnot(None))
+        .union(db.session.query(HeartRateRollup.user_id, HeartRateRollup.member_id))
+        .all()
+    )
+
+    compacted = 0
+    for user_id, member_id in members:
+        # Same lock the save endpoints take, so a concurrent save cannot
+        # fold the same readings or race on the rollup rows
+        FamilyMember.query.filter_by(member_id=member_id).with_for_update().first()
+        compacted += compact_heart_rates(user_id, member_id)
+        db.session.commit()
+
+    print(f"HEART RATE COMPACTION: {compacted} rows folded for {len(members)} members")
+
+
+app.config["HEART_RATE_BULK_MAX"] = int(os.getenv("HEART_RATE_BULK_MAX", 500))
+
+
+def _parse_recorded_at(value, now):
+    """Client timestamp (ISO 8601) as naive UTC; None means "now"."""
+    if not value:
+        return now
+    try:
+        ts = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError("Invalid recorded_at")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(pytz.utc).replace(tzinfo=None)
+    if ts > now + timedelta(minutes=5):
+        raise ValueError("recorded_at is in the future")
+    return ts
+
+
+@csrf.exempt
+@app.route("/api/heart-rate/bulk", methods=["POST"])
+def save_heart_rate_bulk():
+    """
+    Sync queued offline readings:
+    {"readings": [{"member_id", "bpm", "aqi", "pm25", "pm10", "stress",
+                   "impact", "recorded_at", "client_id"}, ...]}
+    Returns one result per reading, in order, so the client can drop the
+    ones that were saved and retry only the rest.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(force=True, silent=True)
+    readings = data.get("readings") if isinstance(data, dict) else None
+
+    if not isinstance(readings, list) or not readings:
+        return jsonify({"error": "readings list required"}), 400
+
+    if len(readings) > app.config["HEART_RATE_BULK_MAX"]:
+        return jsonify({"error": f"At most {app.config['HEART_RATE_BULK_MAX']} readings per request"}), 413
+
+    user_id = session["user_id"]
+    now = datetime.utcnow()
+
+    wanted = {safe_int(r.get("member_id")) for r in readings if isinstance(r, dict)}
+
+    # One query checks ownership and locks every member touched, in a fixed
+    # order so two syncs for the same family cannot deadlock
+    owned = {
+        m.member_id for m in FamilyMember.query.filter(
+            FamilyMember.user_id == user_id,
+            FamilyMember.member_id.in_(wanted)
+        ).order_by(FamilyMember.member_id).with_for_update()
+    }
+
+    results = []
+    rows = []
+
+    for i, item in enumerate(readings):
+        result = {"index": i}
+        if isinstance(item, dict) and item.get("client_id") is not None:
+            result["client_id"] = item["client_id"]
+        results.append(result)
+
+        if not isinstance(item, dict):
+            result["error"] = "Invalid reading"
+            continue
+
+        member_id = safe_int(item.get("member_id"))
+        bpm = safe_int(item.get("bpm"))
+
+        if member_id not in owned:
+            result["error"] = "Invalid member"
+            continue
+
+        if bpm <= 0:
+            result["error"] = "Invalid bpm"
+            continue
+
+        try:
+            created_at = _parse_recorded_at(item.get("recorded_at"), now)
+        except ValueError as e:
+            result["error"] = str(e)
+            continue
+
+        rows.append({
+            "user_id": user_id,
+            "member_id": member_id,
+            "bpm": bpm,
+            "aqi": safe_int(item.get("aqi")),
+            "pm25": safe_float(item.get("pm25")),
+            "pm10": safe_float(item.get("pm10")),
+            "stress_level": item.get("stress"),
+            "impact_category": item.get("impact"),
+            "created_at": created_at
+        })
+        result["success"] = True
+
+    try:
+        if rows:
+            db.session.execute(db.insert(HeartRateRecord), rows)
+            oldest = {}
+            for row in rows:
+                oldest[row["member_id"]] = min(row["created_at"], oldest.get(row["member_id"], row["created_at"]))
+            for member_id in sorted(oldest):
+                compact_if_due(user_id, member_id, now, oldest[member_id])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("Bulk heart rate save failed:", e)
+        return jsonify({"error": "Database error"}), 500
+
+    saved = len(rows)
+    print("BULK SAVED:", "user_id:", user_id, "saved:", saved, "rejected:", len(readings) - saved)
+
+    return jsonify({"saved": saved, "rejected": len(readings) - saved, "results": results})
+
+
+@app.route("/api/heart-rate/history")
+def heart_rate_history():
+    """
+    Long-term trend for a member: /api/heart-rate/history?member_id=3&days=365
+    Weekly and daily rollups merged with recent raw readings summarised per day.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    member_id = request.args.get("member_id", type=int)
+    if not member_id:
+        return jsonify({"error": "member_id required"}), 400
+
+    days = min(max(request.args.get("days", 365, type=int), 1), 3660)
+    since = _utc_midnight(datetime.utcnow() - timedelta(days=days))
+    user_id = session["user_id"]
+
+    rollups = HeartRateRollup.query.filter(
+        HeartRateRollup.user_id == user_id,
+        HeartRateRollup.member_id == member_id,
+        HeartRateRollup.period_start >= since - timedelta(days=6)
+    ).all()
+
+    points = {}
+    for r in rollups:
+        # Weeks are fetched from 6 days early; keep those overlapping the window
+        length = timedelta(days=7 if r.period == "week" else 1)
+        if r.period_start + length > since:
+            points[(r.period, r.period_start)] = r
+
+    raw = member_heart_rates(user_id, member_id).filter(
+        HeartRateRecord.created_at >= since
+    ).with_entities(
+        HeartRateRecord.created_at,
+        HeartRateRecord.bpm,
+        HeartRateRecord.aqi,
+        HeartRateRecord.pm25
+    ).all()
+
+    for day, stats in summarize_readings(raw).items():
+        existing = points.get(("day", day))
+        if existing is not None:
+            # A day can be part rolled up, part raw (e.g. right after compaction)
+            merged = HeartRateRollup(period="day", period_start=day)
+            merged.merge(existing)
+            merged.merge(stats)
+            points[("day", day)] = merged
+        else:
+            points[("day", day)] = rollup_point("day", day, stats)
+
+    series = [p.to_point() if isinstance(p, HeartRateRollup) else p for p in points.values()]
+    series.sort(key=lambda p: p["start"])
+
+    return jsonify({"member_id": member_id, "days": days, "points": series})
+
+
+@csrf.exempt
+@app.route('/save-heart-rate', methods=['POST'])
+def save_heart_rate():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(force=True) or {}
+
+    # ===== MEMBER ID STRICT =====
+    raw_member_id = data.get("member_id")
+    if not raw_member_id:
+        return jsonify({"error": "member_id required"}), 400
+
+    try:
+        member_id = int(raw_member_id)
+    except:
+        return jsonify({"error": "Invalid member_id"}), 400
+
+    # Row lock serialises concurrent saves for the same member
+    member = FamilyMember.query.filter_by(
+        member_id=member_id,
+        user_id=session["user_id"]
+    ).with_for_update().first()
+    if not member:
+        db.session.rollback()
+        return jsonify({"error": "Invalid member"}), 400
+
+    incoming_bpm = safe_int(data.get("bpm"))
+
+    # ===== APPEND + COMPACT IN ONE TRANSACTION =====
+    record = HeartRateRecord(
+        user_id=session["user_id"],
+        member_id=member_id,
+        bpm=incoming_bpm,
+        aqi=safe_int(data.get("aqi")),
+        pm25=safe_float(data.get("pm25")),
+        pm10=safe_float(data.get("pm10")),
+        stress_level=data.get("stress"),
+        impact_category=data.get("impact")
+    )
+
+    append_heart_rate(record)
+    db.session.commit()
+
+    print("SAVED:", 
+          "user_id:", session["user_id"], 
+          "member_id:", member_id, 
+          "bpm:", incoming_bpm)
+
+    return jsonify({"success": True})
+
+
+# =========================
+# PPG ANALYSIS
+# =========================
+app.config["PPG_BATCH_MAX"] = int(os.getenv("PPG_BATCH_MAX", 32))
+
+
+@csrf.exempt
+@app.route("/api/ppg/analyze", methods=["POST"])
+def analyze_ppg():
+    """
+    Server-side BPM from raw camera samples.
+    Body: {"samples": [...], "timestamps": [ms, ...]}
+       or {"buffers": [{"samples": [...], "timestamps": [...]}, ...]}
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "samples and timestamps required"}), 400
+
+    single = "buffers" not in data
+    buffers = [data] if single else data.get("buffers")
+
+    if not isinstance(buffers, list) or not buffers:
+        return jsonify({"error": "samples and timestamps required"}), 400
+
+    if len(buffers) > app.config["PPG_BATCH_MAX"]:
+        return jsonify({"error": f"At most {app.config['PPG_BATCH_MAX']} buffers per request"}), 413
+
+    pairs = [
+        (b.get("samples") or [], b.get("timestamps") or []) if isinstance(b, dict) else ([], [])
+        for b in buffers
+    ]
+    results = ppg.analyze_batch(pairs)
+
+    if single:
+        status = 422 if "error" in results[0] else 200
+        return jsonify(results[0]), status
+
+    return jsonify({"results": results})
+
+
+# Streaming measurement sessions live in this worker's memory; each holds
+# constant-size filter state, and idle ones are dropped
+app.config["PPG_STREAM_MAX_SESSIONS"] = int(os.getenv("PPG_STREAM_MAX_SESSIONS", 500))
+app.config["PPG_STREAM_IDLE_SECONDS"] = int(os.getenv("PPG_STREAM_IDLE_SECONDS", 30))
+app.config["PPG_STREAM_CHUNK_MAX"] = int(os.getenv("PPG_STREAM_CHUNK_MAX", 1024))
+
+ppg_streams = ppg.StreamRegistry(
+    app.config["PPG_STREAM_MAX_SESSIONS"],
+    app.config["PPG_STREAM_IDLE_SECONDS"]
+)
+
+
+def push_ppg_chunk(stream, chunk):
+    """Feed one {"samples", "timestamps"} chunk; returns (payload, status code)."""
+    if not isinstance(chunk, dict):
+        return {"error": "Invalid chunk"}, 400
+
+    samples = chunk.get("samples") or []
+    timestamps = chunk.get("timestamps") or []
+
+    if not isinstance(samples, list) or not isinstance(timestamps, list) or len(samples) != len(timestamps):
+        return {"error": "samples and timestamps must be equal-length lists"}, 400
+
+    if len(samples) > app.config["PPG_STREAM_CHUNK_MAX"]:
+        return {"error": f"At most {app.config['PPG_STREAM_CHUNK_MAX']} samples per chunk"}, 413
+
+    try:
+        stream.push(samples, timestamps)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return stream.status(), 200
+
+
+@csrf.exempt
+@app.route("/api/ppg/stream", methods=["POST"])
+def open_ppg_stream():
+    """Start a chunked-HTTP measurement session (fallback for /ws/ppg)."""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        sid = ppg_streams.open(session["user_id"])
+    except ppg.StreamLimitError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+
+    return jsonify({
+        "session": sid,
+        "idle_timeout": app.config["PPG_STREAM_IDLE_SECONDS"]
+    }), 201
+
+
+@csrf.exempt
+@app.route("/api/ppg/stream/<sid>", methods=["POST", "DELETE"])
+def ppg_stream_chunk(sid):
+    """
+    POST a chunk to get interim {bpm, quality, beats, seconds};
+    add "done": true (or send DELETE) to finish and get the final estimate.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    owner = session["user_id"]
+
+    if request.method == "DELETE":
+        stream = ppg_streams.close(sid, owner)
+        if stream is None:
+            return jsonify({"error": "Unknown or expired session"}), 404
+        return jsonify(dict(stream.status(), final=True))
+
+    stream = ppg_streams.get(sid, owner)
+    if stream is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+
+    chunk = request.get_json(force=True, silent=True)
+    payload, status = push_ppg_chunk(stream, chunk)
+
+    if status == 200 and chunk.get("done"):
+        ppg_streams.close(sid, owner)
+        payload["final"] = True
+
+    return jsonify(payload), status
+
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route("/ws/ppg")
+    def ppg_socket(ws):
+        """
+        One measurement per connection: the client sends JSON chunks and gets
+        a status message back for each; {"done": true} ends the session.
+        """
+        if "user_id" not in session:
+            ws.send(json.dumps({"error": "Unauthorized"}))
+            return
+
+        owner = session["user_id"]
+        try:
+            sid = ppg_streams.open(owner)
+        except ppg.StreamLimitError as e:
+            ws.send(json.dumps({"error": str(e)}))
+            return
+
+        try:
+            while True:
+                message = ws.receive(timeout=app.config["PPG_STREAM_IDLE_SECONDS"])
+                stream = ppg_streams.get(sid, owner)
+                if message is None or stream is None:
+                    break
+
+                try:
+                    chunk = json.loads(message)
+                except ValueError:
+                    ws.send(json.dumps({"error": "Invalid JSON"}))
+                    continue
+
+                payload, status = push_ppg_chunk(stream, chunk)
+                if status == 200 and chunk.get("done"):
+                    payload["final"] = True
+                    ws.send(json.dumps(payload))
+                    break
+                ws.send(json.dumps(payload))
+        finally:
+            ppg_streams.close(sid, owner)
+
+
+# =========================
+# AQI BACKFILL
+# =========================
+from sqlalchemy import update
+
+@app.cli.command("backfill-aqi")
+@click.option("--batch-size", default=5000, show_default=True)
+def backfill_aqi_command(batch_size):
+    """Recompute heart_rate_records.aqi from the stored PM2.5/PM10 values."""
+    last_id = 0
+    updated = 0
+
+    while True:
+        rows = (
+            db.session.query(
+                HeartRateRecord.id,
+                HeartRateRecord.aqi,
+                HeartRateRecord.pm25,
+                HeartRateRecord.pm10
+            )
+            .filter(HeartRateRecord.id > last_id)
+            .order_by(HeartRateRecord.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        ids, current, pm25, pm10 = (np.array(col, dtype=float) for col in zip(*rows))
+
+        # save_heart_rate stores 0 when the client had no reading
+        pm25[pm25 <= 0] = np.nan
+        pm10[pm10 <= 0] = np.nan
+
+        aqi, _ = aqi_engine.compute_aqi(pm25=pm25, pm10=pm10)
+        changed = ~np.isnan(aqi) & (aqi != current)
+
+        if changed.any():
+            db.session.execute(
+                update(HeartRateRecord),
+                [{"id": int(i), "aqi": int(v)} for i, v in zip(ids[changed], aqi[changed])]
+            )
+            db.session.commit()
+            updated += int(changed.sum())
+
+    print(f"AQI BACKFILL: {updated} records updated")
+
+
+# =========================
+# GEOCODE CACHE
+# =========================
+_geocode_lru = OrderedDict()
+_geocode_lock = threading.Lock()
+
+
+def normalize_city(city):
+    """Canonical cache key for a city name ("  New  Delhi " -> "new delhi")."""
+    return gazetteer.normalize_name(city)[:100]
+
+
+def _remember_geocode(key, lat, lon, updated_at):
+    with _geocode_lock:
+        _geocode_lru[key] = (lat, lon, updated_at)
+        _geocode_lru.move_to_end(key)
+        while len(_geocode_lru) > app.config["GEOCODE_LRU_SIZE"]:
+            _geocode_lru.popitem(last=False)
+
+
+def geocode_city(city):
+    """
+    Resolve a city name to (lat, lon).
+    Checks the in-process LRU, then the geocode_cache table, and only
+    calls Nominatim on a miss. Returns None if the city is unknown.
+    """
+    key = normalize_city(city)
+    now = datetime.utcnow()
+    ttl = app.config["GEOCODE_CACHE_TTL"]
+
+    with _geocode_lock:
+        hit = _geocode_lru.get(key)
+        if hit and now - hit[2] < ttl:
+            _geocode_lru.move_to_end(key)
+            return hit[0], hit[1]
+
+    row = db.session.get(GeocodeCache, key)
+    if row and row.updated_at and now - row.updated_at < ttl:
+        _remember_geocode(key, row.lat, row.lon, row.updated_at)
+        return row.lat, row.lon
+
+    try:
+        geo_resp = upstream.get_json(
+            "https://nominatim.openstreetmap.org/search",
+            params={"q": city, "format": "json", "limit": 1}
+        )
+    except Exception:
+        # An expired entry is still better than no answer
+        if row:
+            return row.lat, row.lon
+        raise
+
+    if not geo_resp:
+        return None
+
+    lat = float(geo_resp[0]["lat"])
+    lon = float(geo_resp[0]["lon"])
+
+    if row is None:
+        row = GeocodeCache(city_key=key)
+        db.session.add(row)
+    row.lat = lat
+    row.lon = lon
+    row.updated_at = now
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        # e.g. another worker inserted the same city first
+        db.session.rollback()
+        print("GEOCODE CACHE ERROR:", e)
+
+    _remember_geocode(key, lat, lon, now)
+    return lat, lon
+
+
+def locate_city(city):
+    """
+    (lat, lon, cache key) for a city name, or None if it cannot be found.
+    Known cities and aliases come from the offline gazetteer. Anything else
+    is geocoded remotely and, if it lies close to a known city, shares that
+    city's AQI entry (the same WAQI station would answer for both).
+    """
+    gaz = gazetteer.get_gazetteer()
+    name = gaz.canonical_name(city)
+
+    if name is None:
+        coords = geocode_city(city)
+        if not coords:
+            return None
+
+        nearest, km = gaz.nearest(*coords)
+        if km > app.config["GAZETTEER_SNAP_KM"]:
+            return coords[0], coords[1], normalize_city(city)
+        name = nearest
+
+    lat, lon = gaz.lookup(name)
+    return lat, lon, normalize_city(name)
+
+
+# =========================
+# AQI CACHE
+# =========================
+class AQIError(Exception):
+    """Upstream AQI lookup failed; carries the HTTP status to return."""
+
+    def __init__(self, message, status=502, details=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.details = details
+
+    def to_dict(self):
+        body = {"error": self.message}
+        if self.details is not None:
+            body["details"] = self.details
+        return body
+
+
+_aqi_cache = OrderedDict()   # (lat, lon) -> (payload, fetched_at)
+_aqi_inflight = {}           # (lat, lon) -> Future of the running fetch
+_aqi_lock = threading.Lock()
+
+
+def aqi_cache_key(lat, lon):
+    # ~1 km grid: every lookup for the same metro shares one entry
+    return (round(float(lat), 2), round(float(lon), 2))
+
+
+def _concentration(value):
+    """A WAQI pollutant reading as a float, or None if the feed sent junk."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_waqi_feed(lat, lon):
+    """Call WAQI for the station nearest to lat/lon and normalise the result."""
+    url = f"https://api.waqi.info/feed/geo:{lat};{lon}/"
+    params = {"token": AQICN_API_TOKEN}
+
+    try:
+        resp = upstream.get_json(url, params=params)
+    except upstream.UpstreamError:
+        raise AQIError("AQI API unreachable")
+
+    if resp.get("status") != "ok":
+        raise AQIError("AQICN error", details=resp)
+
+    data = resp["data"]
+
+    # ----------------------------------------------
+    # 🚨 THE FIX: FORCE CALCULATION (US EPA breakpoints)
+    # ----------------------------------------------
+    raw_aqi = data["aqi"]
+    pm25_val = data.get("iaqi", {}).get("pm25", {}).get("v")
+    pm10_val = data.get("iaqi", {}).get("pm10", {}).get("v")
+
+    calculated_aqi, dominant = aqi_engine.overall_aqi(
+        pm25=_concentration(pm25_val), pm10=_concentration(pm10_val)
+    )
+
+    final_aqi = calculated_aqi if calculated_aqi is not None else raw_aqi
+
+    print(f"AQI FETCH: {lat},{lon} | API Says: {raw_aqi} | PM2.5: {pm25_val} | Calculated: {final_aqi}")
+
+    return {
+        "aqi": final_aqi,
+        "pm25": pm25_val,
+        "pm10": pm10_val,
+        "dominant": dominant or data.get("dominentpol"),
+    }
+
+
+def _remember_aqi(key, payload, fetched_at):
+    with _aqi_lock:
+        _aqi_cache[key] = (payload, fetched_at)
+        _aqi_cache.move_to_end(key)
+        while len(_aqi_cache) > app.config["AQI_CACHE_MAX_ENTRIES"]:
+            _aqi_cache.popitem(last=False)
+
+
+def _store_city_aqi(city_key, payload):
+    """Persist the latest reading so other workers and the prefetcher can see it."""
+    row = db.session.get(CityAQI, city_key)
+    if row is None:
+        row = CityAQI(city_key=city_key)
+        db.session.add(row)
+
+    row.aqi = payload["aqi"]
+    row.pm25 = payload["pm25"]
+    row.pm10 = payload["pm10"]
+    row.dominant = payload["dominant"]
+    row.refreshed_at = datetime.utcnow()
+
+    # Every refresh also feeds the city's hourly series
+    hour = row.refreshed_at.replace(minute=0, second=0, microsecond=0)
+    bucket = db.session.get(AQIHourly, (city_key, hour))
+    if bucket is None:
+        bucket = AQIHourly(city_key=city_key, hour=hour, samples=0)
+        db.session.add(bucket)
+    bucket.add_sample(payload)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print("CITY AQI STORE ERROR:", e)
+
+
+def _refresh_aqi(key, lat, lon, future, city_key=None):
+    try:
+        payload = fetch_waqi_feed(lat, lon)
+    except Exception as e:
+        with _aqi_lock:
+            _aqi_inflight.pop(key, None)
+        future.set_exception(e)
+        return
+
+    _remember_aqi(key, payload, time.monotonic())
+    with _aqi_lock:
+        _aqi_inflight.pop(key, None)
+    future.set_result(payload)
+
+    if city_key:
+        _store_city_aqi(city_key, payload)
+
+
+def _refresh_aqi_in_background(*args):
+    with app.app_context():
+        _refresh_aqi(*args)
+
+
+def get_cached_aqi(lat, lon, city_key=None):
+    """
+    AQI for a location, served from cache when possible.
+    - fresh entry: returned as is
+    - fresh row in city_aqi (another worker / the prefetcher): loaded and returned
+    - stale entry: returned immediately while one background refresh runs
+    - miss: concurrent callers for the same key share a single upstream fetch
+    """
+    key = aqi_cache_key(lat, lon)
+    ttl = app.config["AQI_CACHE_TTL"]
+    max_stale = app.config["AQI_CACHE_MAX_STALE"]
+
+    with _aqi_lock:
+        entry = _aqi_cache.get(key)
+    age = time.monotonic() - entry[1] if entry else None
+
+    if entry and age < ttl:
+        return entry[0]
+
+    row = None
+    if city_key:
+        row = db.session.get(CityAQI, city_key)
+        if row and row.refreshed_at:
+            row_age = (datetime.utcnow() - row.refreshed_at).total_seconds()
+            if row_age < ttl:
+                payload = row.to_payload()
+                _remember_aqi(key, payload, time.monotonic() - row_age)
+                return payload
+
+    with _aqi_lock:
+        future = _aqi_inflight.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _aqi_inflight[key] = future
+
+    if entry and age < ttl + max_stale:
+        if owner:
+            threading.Thread(
+                target=_refresh_aqi_in_background,
+                args=(key, lat, lon, future, city_key),
+                daemon=True
+            ).start()
+        return entry[0]
+
+    if owner:
+        _refresh_aqi(key, lat, lon, future, city_key)
+
+    try:
+        return future.result(timeout=30)
+    except Exception:
+        # Upstream is failing (or its circuit is open): an old reading beats an error page
+        if entry:
+            return entry[0]
+        if row:
+            return row.to_payload()
+        raise
+
+
+# =========================
+# AQI PREFETCH
+# =========================
+class TokenBucket:
+    """Blocking token bucket that keeps the prefetcher inside the WAQI budget."""
+
+    def __init__(self, rate_per_min, burst=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = burst or max(1, rate_per_min // 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def registered_cities():
+    """Distinct member/user cities as {normalized key: display name}."""
+    rows = (
+        db.session.query(FamilyMember.city)
+        .filter(FamilyMember.city.isnot(None))
+        .union(db.session.query(User.city).filter(User.city.isnot(None)))
+        .all()
+    )
+
+    gaz = gazetteer.get_gazetteer()
+    cities = {}
+    for (name,) in rows:
+        if name and name.strip():
+            key = normalize_city(gaz.canonical_name(name) or name)
+            cities.setdefault(key, name.strip())
+    return cities
+
+
+def prefetch_city_aqi(city, bucket):
+    with app.app_context():
+        bucket.acquire()
+        located = locate_city(city)
+        if not located:
+            return False
+
+        lat, lon, city_key = located
+        key = aqi_cache_key(lat, lon)
+        with _aqi_lock:
+            future = _aqi_inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                _aqi_inflight[key] = future
+
+        if owner:
+            _refresh_aqi(key, lat, lon, future, city_key)
+            future.result()
+        else:
+            # Someone else is already fetching this cell; reuse their result
+            _store_city_aqi(city_key, future.result(timeout=30))
+        return True
+
+
+def run_aqi_prefetch():
+    """Refresh AQI for every registered city whose reading is about to expire."""
+    if not AQICN_API_TOKEN:
+        print("AQI PREFETCH: AQICN token missing, skipping")
+        return 0, 0
+
+    # Anything that would expire before the next run is due now
+    horizon = app.config["AQI_CACHE_TTL"] - app.config["AQI_PREFETCH_INTERVAL"]
+    cutoff = datetime.utcnow() - timedelta(seconds=max(0, horizon))
+
+    cities = registered_cities()
+    fresh = {
+        key for (key,) in
+        db.session.query(CityAQI.city_key).filter(CityAQI.refreshed_at >= cutoff)
+    }
+    due = [name for key, name in cities.items() if key not in fresh]
+
+    bucket = TokenBucket(app.config["AQI_PREFETCH_RATE_PER_MIN"])
+    workers = app.config["AQI_PREFETCH_WORKERS"]
+    batch_size = workers * 4
+    refreshed = failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i in range(0, len(due), batch_size):
+            batch = due[i:i + batch_size]
+            futures = [pool.submit(prefetch_city_aqi, city, bucket) for city in batch]
+
+            for city, future in zip(batch, futures):
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    ok = False
+                    print("AQI PREFETCH ERROR:", city, e)
+
+                if ok:
+                    refreshed += 1
+                else:
+                    failed += 1
+
+    print(f"AQI PREFETCH: {refreshed} refreshed, {failed} failed, {len(cities) - len(due)} still fresh")
+
+    history_cutoff = datetime.utcnow() - timedelta(days=app.config["AQI_HISTORY_DAYS"])
+    AQIHourly.query.filter(AQIHourly.hour < history_cutoff).delete()
+    db.session.commit()
+
+    return refreshed, failed
+
+
+@app.cli.command("prefetch-aqi")
+@click.option("--loop", is_flag=True, help="Keep running every AQI_PREFETCH_INTERVAL seconds.")
+def prefetch_aqi_command(loop):
+    """Warm the AQI cache for every registered member city."""
+    while True:
+        run_aqi_prefetch()
+        if not loop:
+            break
+        time.sleep(app.config["AQI_PREFETCH_INTERVAL"])
+
+
+def resolve_city_aqi(city):
+    """Locate `city` and return its AQI payload; raises AQIError."""
+    try:
+        located = locate_city(city)
+    except Exception:
+        raise AQIError("Geocoding failed")
+
+    if not located:
+        raise AQIError("City not found", status=404)
+
+    lat, lon, city_key = located
+
+    try:
+        payload = get_cached_aqi(lat, lon, city_key)
+    except AQIError:
+        raise
+    except Exception:
+        raise AQIError("AQI API unreachable")
+
+    return {
+        "city": city,
+        **payload,
         "source": "AQICN / CPCB",
         "scale": "US EPA AQI"
+    }
+
+
+@csrf.exempt
+@app.route("/api/aqi")
+def get_aqi():
+    city = request.args.get("city")
+    if not city:
+        return jsonify({"error": "City required"}), 400
+
+    if not AQICN_API_TOKEN:
+        return jsonify({"error": "AQICN token missing"}), 500
+
+    try:
+        return jsonify(resolve_city_aqi(city))
+    except AQIError as e:
+        return jsonify(e.to_dict()), e.status
+
+
+# Shared by every batch request so total upstream fan-out stays bounded
+_aqi_batch_pool = ThreadPoolExecutor(max_workers=app.config["AQI_BATCH_WORKERS"])
+
+
+def _resolve_city_aqi_in_context(city):
+    with app.app_context():
+        return resolve_city_aqi(city)
+
+
+@csrf.exempt
+@app.route("/api/aqi/batch", methods=["GET", "POST"])
+def get_aqi_batch():
+    """
+    AQI for several cities in one round trip.
+    GET /api/aqi/batch?city=Pune&city=Surat  or  POST {"cities": [...]}
+    Returns {city: payload} with {"error": ...} for cities that failed.
+    """
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        cities = (data.get("cities") if isinstance(data, dict) else None) or []
+    else:
+        cities = request.args.getlist("city")
+
+    cities = [c for c in cities if isinstance(c, str) and c.strip()]
+    if not cities:
+        return jsonify({"error": "cities required"}), 400
+
+    if not AQICN_API_TOKEN:
+        return jsonify({"error": "AQICN token missing"}), 500
+
+    # Spellings of the same city share one lookup
+    unique = {}
+    for city in cities:
+        unique.setdefault(normalize_city(city), city)
+
+    if len(unique) > app.config["AQI_BATCH_MAX_CITIES"]:
+        return jsonify({"error": f"At most {app.config['AQI_BATCH_MAX_CITIES']} cities per request"}), 400
+
+    futures = {
+        key: _aqi_batch_pool.submit(_resolve_city_aqi_in_context, city)
+        for key, city in unique.items()
+    }
+
+    resolved = {}
+    for key, future in futures.items():
+        try:
+            resolved[key] = future.result()
+        except AQIError as e:
+            resolved[key] = e.to_dict()
+        except Exception:
+            resolved[key] = {"error": "AQI API unreachable"}
+
+    return jsonify({city: resolved[normalize_city(city)] for city in cities})
+
+
+# =========================
+# AQI HISTORY
+# =========================
+# range -> (window, resolution of the returned series)
+AQI_HISTORY_RANGES = {
+    "24h": (timedelta(hours=24), timedelta(hours=1)),
+    "7d": (timedelta(days=7), timedelta(hours=6)),
+    "30d": (timedelta(days=30), timedelta(days=1)),
+}
+
+
+def aqi_history(city_key, range_key="24h"):
+    """
+    Downsampled AQI series for a city from the hourly table.
+    Each point is the sample-weighted mean of the hours it covers;
+    empty buckets are omitted.
+    """
+    window, step = AQI_HISTORY_RANGES[range_key]
+    end = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    start = end - window
+
+    rows = (
+        db.session.query(AQIHourly.hour, AQIHourly.samples, AQIHourly.aqi, AQIHourly.pm25, AQIHourly.pm10)
+        .filter(AQIHourly.city_key == city_key, AQIHourly.hour >= start)
+        .order_by(AQIHourly.hour)
+        .all()
+    )
+    if not rows:
+        return []
+
+    hours, samples, *values = zip(*rows)
+    n_buckets = int(window / step)
+    bucket = np.array([int((h - start) / step) for h in hours])
+    samples = np.array(samples, dtype=float)
+
+    series = {}
+    for field, column in zip(("aqi", "pm25", "pm10"), values):
+        v = np.array(column, dtype=float)
+        w = np.where(np.isnan(v), 0.0, samples)
+        total = np.bincount(bucket, weights=np.nan_to_num(v) * w, minlength=n_buckets)
+        weight = np.bincount(bucket, weights=w, minlength=n_buckets)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            series[field] = total / weight
+
+    points = []
+    for i in np.unique(bucket):
+        point = {"time": (start + step * int(i)).isoformat() + "Z"}
+        for field, means in series.items():
+            point[field] = None if np.isnan(means[i]) else round(float(means[i]), 1)
+        points.append(point)
+    return points
+
+
+@app.route("/api/aqi/history")
+def get_aqi_history():
+    """Pre-aggregated city AQI: /api/aqi/history?city=Pune&range=24h|7d|30d"""
+    city = request.args.get("city")
+    range_key = request.args.get("range", "24h")
+
+    if not city:
+        return jsonify({"error": "City required"}), 400
+
+    if range_key not in AQI_HISTORY_RANGES:
+        return jsonify({"error": "range must be one of " + ", ".join(AQI_HISTORY_RANGES)}), 400
+
+    try:
+        located = locate_city(city)
+    except Exception:
+        return jsonify({"error": "Geocoding failed"}), 502
+
+    if not located:
+        return jsonify({"error": "City not found"}), 404
+
+    return jsonify({
+        "city": city,
+        "range": range_key,
+        "resolution_hours": int(AQI_HISTORY_RANGES[range_key][1].total_seconds() // 3600),
+        "points": aqi_history(located[2], range_key)
     })
 
 
+@app.route("/api/cities/search")
+def search_cities():
+    """Offline city-name suggestions: /api/cities/search?q=ahm"""
+    q = request.args.get("q", "")
+    limit = min(request.args.get("limit", 10, type=int), 50)
+    return jsonify(gazetteer.get_gazetteer().search(q, limit=limit))
+
+
+
+# Reports render in a small process pool; beyond REPORT_QUEUE_MAX queued or
+# rendering jobs new requests get 503 + Retry-After instead of piling up.
+# Jobs and results live in the web process that took the submission, so the
+# report pages use /generate-pdf (one request); /api/reports polling needs
+# sticky routing (or a single worker) to reach that process again
+app.config["REPORT_WORKERS"] = int(os.getenv("REPORT_WORKERS", 2))
+app.config["REPORT_QUEUE_MAX"] = int(os.getenv("REPORT_QUEUE_MAX", 16))
+app.config["REPORT_RESULT_TTL"] = int(os.getenv("REPORT_RESULT_TTL", 300))
+app.config["REPORT_SYNC_TIMEOUT"] = int(os.getenv("REPORT_SYNC_TIMEOUT", 30))
+# forkserver or spawn; plain fork is unsafe once request threads are running
+app.config["REPORT_POOL_START_METHOD"] = os.getenv("REPORT_POOL_START_METHOD", "forkserver")
+# Identical reports (same normalized payload) are served from memory
+app.config["REPORT_CACHE_BYTES"] = int(os.getenv("REPORT_CACHE_BYTES", 64 * 1024 * 1024))
+
+report_jobs = reports.ReportQueue(
+    app.config["REPORT_WORKERS"],
+    app.config["REPORT_QUEUE_MAX"],
+    app.config["REPORT_RESULT_TTL"],
+    app.config["REPORT_POOL_START_METHOD"],
+    cache=reports.ReportCache(app.config["REPORT_CACHE_BYTES"])
+)
+
+
+def queue_full_response():
+    return jsonify({"error": "Report queue is full, try again shortly"}), 503, {"Retry-After": "10"}
+
+
+def pdf_response(pdf, key):
+    """
+    The PDF with its content key as a strong ETag. Browsers may keep it
+    but must revalidate, which a matching If-None-Match answers with 304.
+    """
+    resp = send_file(
+        io.BytesIO(pdf),
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"HridyaCare_Report_{datetime.utcnow():%Y%m%d_%H%M%S}.pdf",
+        etag=key,
+        conditional=False
+    )
+    resp.content_length = len(pdf)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
 
 @app.route('/generate-pdf', methods=['POST'])
 @csrf.exempt 
 def generate_pdf():
+    """
+    Synchronous form of /api/reports: queues the render and waits for it,
+    so the PDF comes back from the process that rendered it. A render still
+    running after REPORT_SYNC_TIMEOUT gets 503; it carries on, and the
+    retried request is answered from the same job or the report cache.
+    """
     # 1. Auth Check
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    data = request.json
-    history = data.get("history", [])
+    owner = session["user_id"]
 
-    # Ensure directory exists
-    save_dir = os.path.join("static", "reports")
-    os.makedirs(save_dir, exist_ok=True)
+    try:
+        jid = report_jobs.submit(owner, request.json or {})
+    except reports.QueueFullError:
+        return queue_full_response()
 
-    # Unique filenames
-    unique_id = uuid.uuid4().hex
-    pdf_name = f"HridyaCare_Report_{unique_id}.pdf"
-    img_name = f"hr_graph_{unique_id}.png"
-    
-    pdf_path = os.path.join(save_dir, pdf_name)
-    img_path = os.path.join(save_dir, img_name)
+    status, pdf, key = report_jobs.result(jid, owner, timeout=app.config["REPORT_SYNC_TIMEOUT"])
+
+    if status == "failed":
+        return jsonify({"error": "Failed to generate PDF"}), 500
+
+    if pdf is None:
+        return jsonify({"error": "Report is still rendering, try again shortly"}), 503, {"Retry-After": "5"}
+
+    # Streamed back in this response; nothing is written under static/
+    return pdf_response(pdf, key)
+
+
+@csrf.exempt
+@app.route("/api/reports", methods=["POST"])
+def submit_report():
+    """
+    Queue a PDF report (same payload as /generate-pdf); poll the returned
+    status_url. The job lives in this process only, so with several web
+    workers the status and download requests must be routed back to it.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object required"}), 400
 
     try:
-        # ==================================================
-        # 📊 GENERATE GRAPH IMAGE (THREAD-SAFE METHOD)
-        # ==================================================
-        if history:
-            bpm_values = [h.get("bpm", 0) for h in history]
-            x_values = list(range(1, len(bpm_values) + 1))
-
-            # Use Figure() instead of plt.figure() for thread safety
-            fig = Figure(figsize=(6, 3))
-            ax = fig.add_subplot(111)
-            
-            ax.plot(x_values, bpm_values, marker="o", linewidth=2, color="#f43f5e")
-            ax.fill_between(x_values, bpm_values, color="#f43f5e", alpha=0.15)
-            
-            ax.set_title("Heart Rate Trend (Last 7 Readings)")
-            ax.set_xlabel("Reading")
-            ax.set_ylabel("BPM")
-            ax.grid(True, alpha=0.3)
-            
-            # Save using FigureCanvas
-            FigureCanvas(fig).print_png(img_path)
-
-        # ==================================================
-        # 📄 CREATE PDF
-        # ==================================================
-        c = canvas.Canvas(pdf_path, pagesize=A4)
-        width, height = A4
-        
-        # Margins & Dimensions
-        BOTTOM_MARGIN = 2 * cm
-        LEFT_MARGIN = 2 * cm
-        RIGHT_MARGIN = 2 * cm
-        CONTENT_WIDTH = width - LEFT_MARGIN - RIGHT_MARGIN
-
-        # --- Helper to check page space ---
-        def check_page_break(current_y, needed_height):
-            if current_y - needed_height < BOTTOM_MARGIN:
-                c.showPage()
-                return height - 50 # Reset Y to top
-            return current_y
-
-        # ---------- HEADER ----------
-        c.setFillColorRGB(0.96, 0.26, 0.39) # HridyaCare Pink
-        c.rect(0, height - 70, width, 70, fill=1)
-        c.setFillColor(colors.white)
-        c.setFont("Helvetica-Bold", 22)
-        c.drawCentredString(width / 2, height - 45, "HridyaCare Health Report")
-
-        y = height - 100
-        c.setFillColor(colors.black)
-
-        # ---------- USER INFO ----------
-        c.setFont("Helvetica", 12)
-        c.drawString(LEFT_MARGIN, y, f"Username: {data.get('name', 'User')}")
-        c.drawRightString(width - RIGHT_MARGIN, y, f"Date: {data.get('timestamp')}")
-        y -= 18
-
-        c.drawString(LEFT_MARGIN, y, f"Age: {data.get('age')}")
-        c.drawRightString(width - RIGHT_MARGIN, y, f"City: {data.get('city')}")
-        y -= 30
-
-        # ---------- HEART RATE CARD ----------
-        c.setFillColorRGB(0.95, 0.96, 0.98)
-        c.roundRect(LEFT_MARGIN, y - 80, CONTENT_WIDTH, 80, 12, fill=1)
-        c.setFillColor(colors.black)
-
-        c.setFont("Helvetica-Bold", 20)
-        c.drawCentredString(width / 2, y - 35, f"{data.get('bpm')} BPM")
-
-        c.setFont("Helvetica", 12)
-        c.drawCentredString(width / 2, y - 60, f"Impact: {data.get('impactCategory')}")
-        y -= 100 # Adjusted spacing
-
-        # ---------- AQI DETAILS ----------
-        c.setFillColorRGB(0.97, 0.97, 0.97)
-        c.roundRect(LEFT_MARGIN, y - 70, CONTENT_WIDTH, 70, 10, fill=1)
-        c.setFillColor(colors.black)
-
-        c.setFont("Helvetica-Bold", 12)
-        c.drawString(LEFT_MARGIN + 10, y - 28, f"AQI: {data.get('aqi', '--')} (US EPA)")
-
-        c.setFont("Helvetica", 11)
-        c.drawString(LEFT_MARGIN + 10, y - 48, f"PM2.5: {data.get('pm25', '--')} µg/m³")
-        c.drawRightString(width - RIGHT_MARGIN - 10, y - 48, f"PM10: {data.get('pm10', '--')} µg/m³")
-
-        y -= 90
-
-        # ---------- GRAPH IMAGE ----------
-        if history and os.path.exists(img_path):
-            # Check space for graph (needs approx 180 height)
-            y = check_page_break(y, 180)
-            
-            c.drawImage(
-                img_path,
-                LEFT_MARGIN,
-                y - 180,
-                width=CONTENT_WIDTH,
-                height=160,
-                preserveAspectRatio=True
-            )
-            y -= 240
+        jid = report_jobs.submit(session["user_id"], data)
+    except reports.QueueFullError:
+        return queue_full_response()
 
-        # ---------- HEART RATE TABLE ----------
-        if history:
-            # Check space for Title + minimal table
-            y = check_page_break(y, 100)
-            
-            c.setFont("Helvetica-Bold", 14)
-            c.drawString(LEFT_MARGIN, y, "Last 7 Heart Rate Readings")
-            y -= 20
-
-            hr_table_data = [["#", "BPM", "Time"]]
-            # Limit history to prevent huge tables if needed, or paginate inside
-            # For now, we take the last 7 strictly
-            for i, h in enumerate(history[:7][::-1], 1):
-                hr_table_data.append([str(i), str(h.get("bpm", "--")), h.get("time", "--")])
-
-            hr_table = Table(hr_table_data, colWidths=[2 * cm, 3 * cm, CONTENT_WIDTH - 5 * cm])
-            hr_table.setStyle(TableStyle([
-                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-                ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-                ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-                ("FONT", (0, 0), (-1, 0), "Helvetica-Bold"),
-            ]))
-
-            _, table_height = hr_table.wrap(CONTENT_WIDTH, height)
-            
-            # Check if table fits, if not new page
-            y = check_page_break(y, table_height)
-            
-            hr_table.drawOn(c, LEFT_MARGIN, y - table_height)
-            y -= (table_height + 30)
-
-        # ---------- AQI REFERENCE TABLE ----------
-        # Check space for Title + AQI Table (approx 150-200 units)
-        y = check_page_break(y, 200)
-
-        c.setFont("Helvetica-Bold", 14)
-        c.drawString(LEFT_MARGIN, y, "AQI Reference (US EPA Scale)")
-        y -= 20
-
-        styles = getSampleStyleSheet()
-        cell_style = styles["BodyText"]
-        cell_style.fontSize = 9
-        cell_style.leading = 11
-
-        aqi_table_data = [
-            [Paragraph("<b>AQI Range</b>", cell_style),
-             Paragraph("<b>Category</b>", cell_style),
-             Paragraph("<b>Health Meaning</b>", cell_style)],
-            ["0–50", "Good", "Air quality is satisfactory"],
-            ["51–100", "Moderate", "Some pollutants may affect sensitive people"],
-            ["101–150", "Sensitive Groups", "Lung/heart disease risks"],
-            ["151–200", "Unhealthy", "Everyone may experience effects"],
-            ["201–300", "Very Unhealthy", "Health alert: increased risk"],
-            ["301+", "Hazardous", "Emergency conditions"],
-        ]
+    # A cached or already-submitted report comes back as done right away
+    status = report_jobs.status(jid, session["user_id"])
+    status_url = url_for("report_status", jid=jid)
+    return jsonify({
+        "id": jid,
+        "status": status,
+        "status_url": status_url,
+        "download_url": url_for("download_report", jid=jid)
+    }), 200 if status == "done" else 202, {"Location": status_url}
 
-        aqi_table = Table(aqi_table_data, colWidths=[2.5 * cm, 4 * cm, CONTENT_WIDTH - 6.5 * cm])
-        aqi_table.setStyle(TableStyle([
-            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#fee2e2")),
-            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
-            ("ALIGN", (0, 0), (-1, -1), "LEFT"),
-            ("VALIGN", (0, 0), (-1, -1), "TOP"),
-            ("PADDING", (0,0), (-1,-1), 6),
-        ]))
 
-        _, aqi_height = aqi_table.wrap(CONTENT_WIDTH, height)
-        
-        # We already checked for space above, but good double check
-        y = check_page_break(y, aqi_height)
-        
-        aqi_table.drawOn(c, LEFT_MARGIN, y - aqi_height)
-        y -= (aqi_height + 20)
+@app.route("/api/reports/<jid>")
+def report_status(jid):
+    """{"id", "status": queued|rendering|done|failed, "download_url"?}"""
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-        # ---------- FOOTER / DISCLAIMER ----------
-        y = check_page_break(y, 30)
-        c.setFont("Helvetica-Oblique", 10)
-        c.setFillColor(colors.grey)
-        c.drawString(LEFT_MARGIN, y, "This report provides wellness insights and is not a medical diagnosis.")
+    status = report_jobs.status(jid, session["user_id"])
+    if status is None:
+        return jsonify({"error": "Unknown or expired report"}), 404
 
-        c.showPage()
-        c.save()
+    payload = {"id": jid, "status": status}
+    if status == "done":
+        payload["download_url"] = url_for("download_report", jid=jid)
+        return jsonify(payload)
 
-        return jsonify({
-            "pdf_url": url_for("static", filename=f"reports/{pdf_name}")
-        })
+    headers = {} if status == "failed" else {"Retry-After": "1"}
+    return jsonify(payload), 200, headers
 
-    except Exception as e:
-        # Log the error properly in production
-        print(f"Error generating PDF: {e}")
+
+@app.route("/api/reports/<jid>/pdf")
+def download_report(jid):
+    if "user_id" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    status, pdf, key = report_jobs.result(jid, session["user_id"])
+
+    if status is None:
+        return jsonify({"error": "Unknown or expired report"}), 404
+    if status == "failed":
         return jsonify({"error": "Failed to generate PDF"}), 500
+    if pdf is None:
+        return jsonify({"id": jid, "status": status}), 409, {"Retry-After": "1"}
+
+    return pdf_response(pdf, key)
+
+
+# Coach caseload export: one report per patient, zipped as each finishes
+app.config["COACH_EXPORT_MAX"] = int(os.getenv("COACH_EXPORT_MAX", 500))
+EXPORT_READINGS = 7
+
+
+def caseload_report_payloads(coach_id, patient_ids, since, tz):
+    """
+    /generate-pdf style payloads for each of the coach's patients among
+    `patient_ids`, from their own ("self") readings since `since`, in three
+    queries however many patients: profiles, the last EXPORT_READINGS
+    readings per patient via ROW_NUMBER() and the latest stress assessment
+    per patient. Returns {patient id: payload}; other ids are left out.
+    """
+    is_self = db.and_(FamilyMember.user_id == User.id, FamilyMember.relationship == "self")
+    profiles = (
+        db.session.query(User.id, FamilyMember.age, FamilyMember.city)
+        .outerjoin(FamilyMember, is_self)
+        .filter(User.id.in_(patient_ids), User.role == "user", coach_patient(coach_id))
+        .all()
+    )
+    if not profiles:
+        return {}
+
+    ids = [p.id for p in profiles]
+    own = db.and_(FamilyMember.member_id == HeartRateRecord.member_id, FamilyMember.relationship == "self")
+
+    # --- last N readings per patient inside the window ---
+    hr_rank = db.func.row_number().over(
+        partition_by=HeartRateRecord.user_id,
+        order_by=(HeartRateRecord.created_at.desc(), HeartRateRecord.id.desc())
+    ).label("rank")
+    recent = (
+        db.session.query(
+            HeartRateRecord.user_id, HeartRateRecord.bpm, HeartRateRecord.created_at,
+            HeartRateRecord.aqi, HeartRateRecord.pm25, HeartRateRecord.pm10,
+            HeartRateRecord.impact_category, hr_rank
+        )
+        .join(FamilyMember, own)
+        .filter(HeartRateRecord.user_id.in_(ids), HeartRateRecord.created_at >= since)
+        .subquery()
+    )
+    readings = (
+        db.session.query(recent)
+        .filter(recent.c.rank <= EXPORT_READINGS)
+        .order_by(recent.c.user_id, recent.c.rank)
+        .all()
+    )
 
-    finally:
-        # 🧹 ALWAYS CLEAN UP THE IMAGE
-        if os.path.exists(img_path):
-            os.remove(img_path)
+    # --- latest stress assessment per patient ---
+    stress_rank = db.func.row_number().over(
+        partition_by=StressAssessment.user_id,
+        order_by=(StressAssessment.updated_at.desc(), StressAssessment.id.desc())
+    ).label("rank")
+    ranked_stress = (
+        db.session.query(
+            StressAssessment.user_id, StressAssessment.emotional, StressAssessment.control,
+            StressAssessment.resilience, StressAssessment.cognitive, StressAssessment.anger, stress_rank
+        )
+        .join(FamilyMember, db.and_(
+            FamilyMember.member_id == StressAssessment.member_id,
+            FamilyMember.relationship == "self"
+        ))
+        .filter(StressAssessment.user_id.in_(ids))
+        .subquery()
+    )
+    stress = {
+        r.user_id: r for r in
+        db.session.query(ranked_stress).filter(ranked_stress.c.rank == 1)
+    }
 
-# FIND THIS FUNCTION AND REPLACE IT
-def coach_required(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if "user_id" not in session:
-            return redirect(url_for("login"))
+    history = {}
+    for r in readings:
+        history.setdefault(r.user_id, []).append(r)
+
+    # Dated by day so re-exports the same day hit the report cache
+    today = datetime.now(tz).strftime("%d %b %Y")
+    payloads = {}
+
+    for p in profiles:
+        rows = history.get(p.id, [])
+        latest = rows[0] if rows else None
+        s = stress.get(p.id)
+
+        payloads[p.id] = {
+            "name": f"Patient-{p.id:04d}",
+            "age": p.age or "N/A",
+            "city": p.city or "N/A",
+            "timestamp": today,
+            "bpm": latest.bpm if latest else "--",
+            "impactCategory": (latest.impact_category if latest else None) or "N/A",
+            "aqi": (latest.aqi if latest else None) or 0,
+            "pm25": (latest.pm25 if latest else None) or 0,
+            "pm10": (latest.pm10 if latest else None) or 0,
+            "history": [
+                {
+                    "bpm": r.bpm,
+                    "time": pytz.utc.localize(r.created_at).astimezone(tz).strftime("%d %b %Y %I:%M %p"),
+                    "aqi": r.aqi
+                }
+                for r in rows
+            ],
+            "stress": {
+                key: getattr(s, key) for key in ("emotional", "control", "resilience", "cognitive", "anger")
+            } if s else None
+        }
 
-        # ✅ FIXED: Use SQLAlchemy instead of get_db_connection
-        user = User.query.get(session["user_id"])
+    return payloads
 
-        if not user or user.role != "coach":
-            return redirect(url_for("index"))
 
-        return f(*args, **kwargs)
-    return wrapper
+@csrf.exempt
+@app.route("/api/coach/reports/export", methods=["POST"])
+@requires_role("coach", api=True)
+def export_caseload_reports():
+    """
+    ZIP of per-patient PDF reports: {"patient_ids": [...], "days": 7}.
+    Only the coach's own patients are exported. Reports render in parallel
+    and are streamed as each one completes; patients that could not be
+    included are listed in MISSING.txt.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get("patient_ids")
+
+    if not isinstance(ids, list) or not ids or not all(type(i) is int for i in ids):
+        return jsonify({"error": "patient_ids must be a non-empty list of ids"}), 400
+
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > app.config["COACH_EXPORT_MAX"]:
+        return jsonify({"error": f"At most {app.config['COACH_EXPORT_MAX']} patients per export"}), 413
+
+    # Reports list individual readings, which are kept HEART_RATE_RAW_DAYS
+    max_days = min(90, app.config["HEART_RATE_RAW_DAYS"])
+    days = data.get("days", 7)
+    if type(days) is not int or not 1 <= days <= max_days:
+        return jsonify({"error": f"days must be between 1 and {max_days}"}), 400
+
+    # Export renders claim slots under the report queue's limit one at a
+    # time; this only turns an already full queue away before streaming
+    window = max(1, min(app.config["REPORT_WORKERS"] * 2, app.config["REPORT_QUEUE_MAX"]))
+    if not report_jobs.has_room(1):
+        return queue_full_response()
+
+    payloads = caseload_report_payloads(
+        current_principal().id, ids, datetime.utcnow() - timedelta(days=days), user_timezone()
+    )
+    if not payloads:
+        return jsonify({"error": "No matching patients"}), 404
+
+    missing = [f"Patient-{i:04d}: not one of your patients" for i in ids if i not in payloads]
+
+    def files():
+        jobs = ((f"{payloads[i]['name']}.pdf", payloads[i]) for i in ids if i in payloads)
+        for name, pdf in report_jobs.render_many(jobs, window):
+            if pdf is None:
+                missing.append(f"{name[:-4]}: failed to render")
+                continue
+            yield name, pdf
+        if missing:
+            yield "MISSING.txt", "\n".join(missing) + "\n"
+
+    return Response(
+        reports.stream_zip(files()),
+        mimetype="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename=HridyaCare_Reports_{datetime.utcnow():%Y%m%d}.zip",
+            "Cache-Control": "no-store"
+        }
+    )
 
     
 @app.route("/register", methods=["GET", "POST"])
@@ -1665,15 +3386,9 @@ def register():
 
 # FIND THIS ROUTE AND REPLACE IT
 @app.route("/coach/entry")
+@requires_role("coach")
 def coach_entry():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    # ✅ FIXED: Use SQLAlchemy
-    user = User.query.get(session["user_id"])
-
-    if not user or user.role != "coach":
-        return redirect(url_for("index"))
+    user = current_principal()
 
     if user.verification_status == "approved":
         return redirect(url_for("coach_dashboard"))
@@ -1688,14 +3403,8 @@ def index():
     return render_template("pages/index.html")
 
 @app.route("/admin/coaches")
+@requires_role("admin")
 def admin_coaches():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    admin = User.query.get(session["user_id"])
-    if not admin or admin.role != "admin":
-        return redirect(url_for("index"))
-
     coaches = User.query.filter_by(role="coach", verification_status="pending").all()
 
     return render_template("dashboard/admin_coaches.html", coaches=coaches)
@@ -1741,6 +3450,7 @@ def login():
     return render_template("auth/login.html")
 
 @app.route("/admin/coach/approve/<int:coach_id>")
+@requires_role("admin")
 def approve_coach(coach_id):
     coach = User.query.get(coach_id)
     if coach:
@@ -1750,6 +3460,7 @@ def approve_coach(coach_id):
     return redirect(url_for("admin_coaches"))
 
 @app.route("/admin/coach/reject/<int:coach_id>")
+@requires_role("admin")
 def reject_coach(coach_id):
     coach = User.query.get(coach_id)
     if coach:
@@ -1759,15 +3470,8 @@ def reject_coach(coach_id):
     return redirect(url_for("admin_coaches"))
 
 @app.route("/uploads/certificates/<path:filename>")
+@requires_role("admin")
 def view_certificate(filename):
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    user = User.query.get(session["user_id"])
-
-    if not user or user.role != "admin":
-        return redirect(url_for("index"))
-
     filename = os.path.basename(filename)
     file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
 
@@ -1777,15 +3481,9 @@ def view_certificate(filename):
     return send_file(file_path)
 
 @app.route("/api/coach/patient/<int:user_id>")
+@requires_role("coach", api=True)
 def get_patient_details(user_id):
-    if "user_id" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
-
-    coach = User.query.get(session["user_id"])
-    if not coach or coach.role != "coach":
-        return jsonify({"error": "Forbidden"}), 403
-
-    notes = CoachNote.query.filter_by(user_id=user_id).order_by(CoachNote.created_at.desc()).all()
+    notes = coach_notes_for(user_id).all()
 
     return jsonify({
         "notes": [
@@ -1798,10 +3496,8 @@ def get_patient_details(user_id):
 
 @csrf.exempt
 @app.route("/api/coach/add-note", methods=["POST"])
+@requires_role("coach", api=True)
 def add_coach_note():
-    if "user_id" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
-
     data = request.json
     patient_id = data.get("patient_id")
     note = data.get("note")
@@ -1809,11 +3505,6 @@ def add_coach_note():
     if not patient_id or not note:
         return jsonify({"error": "Invalid data"}), 400
 
-    coach = User.query.get(session["user_id"])
-
-    if not coach or coach.role != "coach":
-        return jsonify({"error": "Forbidden"}), 403
-
     note_obj = CoachNote(
         coach_id=session["user_id"],
         user_id=patient_id,
@@ -1827,14 +3518,9 @@ def add_coach_note():
 
 
 @app.route("/api/coach/profile")
+@requires_role("coach", api=True)
 def coach_profile():
-    if "user_id" not in session:
-        return jsonify({"error": "Unauthorized"}), 401
-
-    coach = User.query.get(session["user_id"])
-
-    if not coach or coach.role != "coach":
-        return jsonify({"error": "Not a coach"}), 403
+    coach = current_principal()
 
     return jsonify({
         "id": coach.id,
@@ -1849,16 +3535,13 @@ def telehealth_data():
         return jsonify({"error": "Unauthorized"}), 401
     
     # 1. Get latest Coach Note
-    note = CoachNote.query.filter_by(user_id=session["user_id"]).order_by(CoachNote.created_at.desc()).first()
+    note = coach_notes_for(session["user_id"]).first()
 
     # 2. Get latest Heart Rate (as a proxy for health metrics if you don't have a specific table)
-    user = User.query.get(session["user_id"])
-
-    hr = HeartRateRecord.query.filter_by(
-        user_id=session["user_id"],
-        member_id=request.args.get("member_id", type=int)
-
-    ).order_by(HeartRateRecord.created_at.desc()).first()
+    hr = member_heart_rates(
+        session["user_id"],
+        request.args.get("member_id", type=int)
+    ).first()
 
     return jsonify({
         "avg_bpm": hr.bpm if hr else "--",
@@ -2006,7 +3689,8 @@ def get_family_members():
         {
             "id": m.member_id,
             "name": m.member_name,
-            "relationship": m.relationship
+            "relationship": m.relationship,
+            "city": m.city
         } for m in members
     ])
 
@@ -2071,6 +3755,11 @@ def delete_family_member(member_id):
             user_id=session["user_id"]
         ).delete()
 
+        HeartRateRollup.query.filter_by(
+            member_id=member_id,
+            user_id=session["user_id"]
+        ).delete()
+
 
         db.session.delete(member)
         db.session.commit()
@@ -2085,6 +3774,31 @@ def delete_family_member(member_id):
     
 from sqlalchemy import func 
 
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Kolkata")
+
+
+@lru_cache(maxsize=64)
+def get_timezone(name):
+    """pytz zone for an IANA name, or None if unknown (lookups are cached)."""
+    try:
+        return pytz.timezone(name)
+    except (pytz.UnknownTimeZoneError, AttributeError):
+        return None
+
+
+def user_timezone():
+    """
+    Display timezone for this request: ?tz= (remembered in the session),
+    then the session's, then DEFAULT_TIMEZONE.
+    """
+    requested = request.args.get("tz")
+    if requested and get_timezone(requested):
+        session["timezone"] = requested
+        return get_timezone(requested)
+
+    return get_timezone(session.get("timezone") or DEFAULT_TIMEZONE) or pytz.utc
+
+
 @app.route('/api/heart-rate/last-7')
 def get_last_7_heart_rates():
     if 'user_id' not in session:
@@ -2092,33 +3806,39 @@ def get_last_7_heart_rates():
 
     target_member_id = request.args.get("member_id", type=int)
 
-    query = HeartRateRecord.query.filter_by(
-        user_id=session["user_id"],
-        member_id=target_member_id
-    )
-
     if not target_member_id:
         return jsonify({"error": "member_id required"}), 400
 
-
-    records = query.order_by(HeartRateRecord.created_at.desc()).limit(7).all()
+    records = (
+        member_heart_rates(session["user_id"], target_member_id)
+        .outerjoin(FamilyMember, FamilyMember.member_id == HeartRateRecord.member_id)
+        .with_entities(
+            HeartRateRecord.bpm,
+            HeartRateRecord.created_at,
+            HeartRateRecord.aqi,
+            HeartRateRecord.pm25,
+            HeartRateRecord.pm10,
+            FamilyMember.member_name
+        )
+        .limit(7)
+        .all()
+    )
     if not records:
         return jsonify([])
 
+    tz = user_timezone()
     result = []
-    ist = pytz.timezone("Asia/Kolkata")
 
     for r in records:
-        member = FamilyMember.query.get(r.member_id)
-        member_name = member.member_name if member else session["username"]
-
-        local_time = r.created_at.replace(tzinfo=pytz.utc).astimezone(ist)
+        local_time = pytz.utc.localize(r.created_at).astimezone(tz)
 
         result.append({
             "bpm": r.bpm,
-            "member_name": member_name,
+            "member_name": r.member_name or session["username"],
             "time": local_time.strftime("%d %b %Y %I:%M %p"),
-            
+            "timestamp": local_time.isoformat(),
+            "timezone": tz.zone,
+
             "aqi": r.aqi,
             "pm25": r.pm25,
             "pm10": r.pm10
@@ -2144,7 +3864,7 @@ def set_selected_member():
     if not member:
         return jsonify({"error": "Invalid member"}), 403
 
-    user = User.query.get(session["user_id"])
+    user = current_principal()
     user.selected_member_id = member_id
     db.session.commit()
 
@@ -2156,8 +3876,8 @@ def get_selected_member():
     if "user_id" not in session:
         return jsonify({"member_id": None})
 
-    user = User.query.get(session["user_id"])
-    return jsonify({"member_id": user.selected_member_id})
+    user = current_principal()
+    return jsonify({"member_id": user.selected_member_id if user else None})
 
 @csrf.exempt
 @app.route("/api/member/update-medical", methods=["POST"])
@@ -2228,10 +3948,7 @@ def blood_donation_eligibility():
     if bmi < 18.5 or bmi > 30:
         return jsonify({"eligible": False, "reason": f"BMI unsafe ({round(bmi,1)})"})
 
-    hr_records = HeartRateRecord.query.filter_by(
-        user_id=session["user_id"],
-        member_id=member_id
-    ).order_by(HeartRateRecord.created_at.desc()).limit(7).all()
+    hr_records = member_heart_rates(session["user_id"], member_id).limit(7).all()
 
     if len(hr_records) < 3:
         return jsonify({"eligible": False, "reason": "Not enough heart rate data"})
@@ -2241,10 +3958,7 @@ def blood_donation_eligibility():
     if avg_hr < 50 or avg_hr > 100:
         return jsonify({"eligible": False, "reason": f"Unstable heart rate ({int(avg_hr)} BPM)"})
 
-    stress = StressAssessment.query.filter_by(
-        user_id=session["user_id"],
-        member_id=member_id
-    ).order_by(StressAssessment.updated_at.desc()).first()
+    stress = member_stress(session["user_id"], member_id).first()
 
     if stress and stress.total_score and stress.total_score > 25:
         return jsonify({"eligible": False, "reason": "High stress detected"})
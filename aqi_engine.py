@@ -0,0 +1,94 @@
+"""
+US EPA AQI engine.
+
+Table-driven breakpoint interpolation for PM2.5, PM10, O3, NO2, SO2 and CO.
+Every function accepts scalars or NumPy arrays, so a whole history can be
+converted in one call. Missing values (None / NaN) stay NaN.
+"""
+import numpy as np
+
+
+# AQI category bounds shared by every pollutant
+_INDEX_BOUNDS = [(0, 50), (51, 100), (101, 150), (151, 200), (201, 300), (301, 400), (401, 500)]
+
+# Concentration breakpoints (low, high) per AQI category.
+# PM in µg/m³ (24h), O3 in ppb (8h), NO2/SO2 in ppb (1h), CO in ppm (8h).
+_CONCENTRATION_BOUNDS = {
+    "pm25": [(0.0, 12.0), (12.1, 35.4), (35.5, 55.4), (55.5, 150.4),
+             (150.5, 250.4), (250.5, 350.4), (350.5, 500.4)],
+    "pm10": [(0, 54), (55, 154), (155, 254), (255, 354),
+             (355, 424), (425, 504), (505, 604)],
+    # The 8-hour O3 table stops at "Very Unhealthy"; above it we report 500
+    "o3": [(0, 54), (55, 70), (71, 85), (86, 105), (106, 200)],
+    "no2": [(0, 53), (54, 100), (101, 360), (361, 649),
+            (650, 1249), (1250, 1649), (1650, 2049)],
+    "so2": [(0, 35), (36, 75), (76, 185), (186, 304),
+            (305, 604), (605, 804), (805, 1004)],
+    "co": [(0.0, 4.4), (4.5, 9.4), (9.5, 12.4), (12.5, 15.4),
+           (15.5, 30.4), (30.5, 40.4), (40.5, 50.4)],
+}
+
+POLLUTANTS = tuple(_CONCENTRATION_BOUNDS)
+MAX_AQI = 500
+
+
+def _build_tables():
+    tables = {}
+    for pollutant, bounds in _CONCENTRATION_BOUNDS.items():
+        c_lo, c_hi = np.array(bounds, dtype=float).T
+        i_lo, i_hi = np.array(_INDEX_BOUNDS[:len(bounds)], dtype=float).T
+        tables[pollutant] = (c_lo, c_hi, i_lo, (i_hi - i_lo) / (c_hi - c_lo))
+    return tables
+
+
+_TABLES = _build_tables()
+
+
+def sub_index(pollutant, concentration):
+    """
+    AQI sub-index for one pollutant.
+    A concentration falls in the first band whose upper bound it does not
+    exceed, so values in the gaps between bands (e.g. 12.05 µg/m³) are
+    interpolated from the next band, same as the original if-chain.
+    """
+    c_lo, c_hi, i_lo, slope = _TABLES[pollutant]
+    c = np.asarray(concentration, dtype=float)
+
+    band = np.searchsorted(c_hi, c, side="left")
+    in_table = np.minimum(band, len(c_hi) - 1)
+
+    index = np.round(slope[in_table] * (c - c_lo[in_table]) + i_lo[in_table])
+    index = np.where(band >= len(c_hi), MAX_AQI, index)
+    index = np.where(c < 0, 0, index)
+    return np.where(np.isnan(c), np.nan, index)
+
+
+def compute_aqi(**concentrations):
+    """
+    Overall AQI and dominant pollutant.
+    Keyword arguments are pollutant names from POLLUTANTS; arrays are
+    broadcast against each other. Returns (aqi, dominant) where aqi is a
+    float array (NaN if nothing was measured) and dominant an object array
+    of pollutant names (None where aqi is NaN).
+    """
+    names = [p for p in POLLUTANTS if concentrations.get(p) is not None]
+    if not names:
+        return np.array(np.nan), np.array(None, dtype=object)
+
+    subs = np.stack(np.broadcast_arrays(*[sub_index(p, concentrations[p]) for p in names]))
+    filled = np.where(np.isnan(subs), -1.0, subs)
+
+    best = filled.argmax(axis=0)
+    aqi = np.take_along_axis(filled, best[np.newaxis], axis=0)[0]
+    missing = aqi < 0
+
+    dominant = np.where(missing, None, np.array(names, dtype=object)[best])
+    return np.where(missing, np.nan, aqi), dominant
+
+
+def overall_aqi(**concentrations):
+    """Scalar convenience wrapper: (aqi as int or None, dominant or None)."""
+    aqi, dominant = compute_aqi(**concentrations)
+    if np.isnan(aqi):
+        return None, None
+    return int(aqi), dominant.item()
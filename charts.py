@@ -0,0 +1,240 @@
+"""
+Report charts as reportlab vector graphics.
+
+Each chart is returned as a reportlab Drawing that reports.py places
+directly on the PDF canvas, so nothing is rasterized and matplotlib is never
+imported. matplotlib_trend() remains as an optional raster fallback for the
+heart-rate chart (REPORT_CHART_BACKEND=matplotlib).
+"""
+import io
+import math
+
+from reportlab.graphics.shapes import Circle, Drawing, Group, Line, PolyLine, Polygon, Rect, String
+from reportlab.lib import colors
+
+
+ROSE = colors.HexColor("#f43f5e")
+ROSE_FILL = colors.Color(ROSE.red, ROSE.green, ROSE.blue, alpha=0.15)
+GRID = colors.Color(0, 0, 0, alpha=0.12)
+AXIS = colors.HexColor("#64748b")
+TEXT = colors.HexColor("#1e293b")
+
+FONT = "Helvetica"
+FONT_BOLD = "Helvetica-Bold"
+
+# Plot area insets (points): room for tick labels, axis labels and the title
+PAD_LEFT, PAD_RIGHT, PAD_BOTTOM, PAD_TOP = 42, 10, 30, 22
+
+# Upper bound of each US EPA AQI category and its standard colour
+AQI_COLORS = [
+    (50, colors.HexColor("#00e400")),
+    (100, colors.HexColor("#ffff00")),
+    (150, colors.HexColor("#ff7e00")),
+    (200, colors.HexColor("#ff0000")),
+    (300, colors.HexColor("#8f3f97")),
+    (math.inf, colors.HexColor("#7e0023")),
+]
+
+# PSS-10 sub-scales as sent by /api/stress/save: (key, label, maximum)
+PSS_DIMENSIONS = [
+    ("emotional", "Emotional", 12),
+    ("control", "Control", 12),
+    ("resilience", "Resilience", 16),
+    ("cognitive", "Cognitive", 8),
+    ("anger", "Anger", 8),
+]
+
+
+def nice_ticks(lo, hi, count=5):
+    """Round tick values (1/2/5 x 10^k steps) covering [lo, hi]."""
+    if hi <= lo:
+        hi = lo + 1
+    raw = (hi - lo) / count
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw)
+
+    first = math.floor(lo / step) * step
+    last = math.ceil(hi / step) * step
+    n = int(round((last - first) / step))
+    return [first + i * step for i in range(n + 1)]
+
+
+def _tick_label(value):
+    return f"{value:g}"
+
+
+def _value_axis(d, ticks, y_of, x0, x1):
+    """Horizontal grid lines with labels on the left edge of the plot."""
+    for t in ticks:
+        y = y_of(t)
+        d.add(Line(x0, y, x1, y, strokeColor=GRID, strokeWidth=0.5))
+        d.add(String(x0 - 4, y - 2.5, _tick_label(t), fontName=FONT, fontSize=7,
+                     fillColor=AXIS, textAnchor="end"))
+
+
+def _frame(d, x0, y0, x1, y1, title, x_label, y_label):
+    d.add(Line(x0, y0, x1, y0, strokeColor=AXIS, strokeWidth=0.6))
+    d.add(Line(x0, y0, x0, y1, strokeColor=AXIS, strokeWidth=0.6))
+
+    if title:
+        d.add(String((x0 + x1) / 2, d.height - 13, title, fontName=FONT_BOLD, fontSize=10,
+                     fillColor=TEXT, textAnchor="middle"))
+    if x_label:
+        d.add(String((x0 + x1) / 2, 4, x_label, fontName=FONT, fontSize=8,
+                     fillColor=TEXT, textAnchor="middle"))
+    if y_label:
+        # Rotated 90° to run up the left edge
+        label = Group(String(0, 0, y_label, fontName=FONT, fontSize=8, fillColor=TEXT, textAnchor="middle"))
+        label.transform = (0, 1, -1, 0, 10, (y0 + y1) / 2)
+        d.add(label)
+
+
+def heart_rate_trend(values, width, height, title="Heart Rate Trend (Last 7 Readings)"):
+    """Line + filled area of `values` against reading number 1..n."""
+    values = [float(v or 0) for v in values]
+    d = Drawing(width, height)
+    if not values:
+        return d
+
+    x0, x1 = PAD_LEFT, width - PAD_RIGHT
+    y0, y1 = PAD_BOTTOM, height - PAD_TOP
+
+    # The area is filled down to zero, so the value axis starts there
+    ticks = nice_ticks(min(0.0, min(values)), max(values))
+    lo, hi = ticks[0], ticks[-1]
+
+    n = len(values)
+    span = max(n - 1, 1)
+    margin = 0.05 * span
+
+    def x_of(i):
+        return x0 + (i - 1 + margin) / (span + 2 * margin) * (x1 - x0)
+
+    def y_of(v):
+        return y0 + (v - lo) / (hi - lo) * (y1 - y0)
+
+    _value_axis(d, ticks, y_of, x0, x1)
+
+    step = max(1, int(math.ceil(n / 10)))
+    for i in range(1, n + 1, step):
+        x = x_of(i)
+        d.add(Line(x, y0, x, y1, strokeColor=GRID, strokeWidth=0.5))
+        d.add(String(x, y0 - 10, str(i), fontName=FONT, fontSize=7, fillColor=AXIS, textAnchor="middle"))
+
+    points = []
+    for i, v in enumerate(values, 1):
+        points += [x_of(i), y_of(v)]
+
+    base = y_of(max(lo, 0.0))
+    d.add(Polygon([x_of(1), base] + points + [x_of(n), base],
+                  fillColor=ROSE_FILL, strokeColor=None, strokeWidth=0))
+    d.add(PolyLine(points, strokeColor=ROSE, strokeWidth=2, strokeLineJoin=1, strokeLineCap=1))
+    for i in range(0, len(points), 2):
+        d.add(Circle(points[i], points[i + 1], 2.6, fillColor=ROSE, strokeColor=colors.white, strokeWidth=0.6))
+
+    _frame(d, x0, y0, x1, y1, title, "Reading", "BPM")
+    return d
+
+
+def aqi_color(aqi):
+    return next(color for bound, color in AQI_COLORS if aqi <= bound)
+
+
+def aqi_bars(values, width, height, title="AQI per Reading"):
+    """One bar per reading, coloured by its US EPA category; None is skipped."""
+    d = Drawing(width, height)
+    known = [v for v in values if v is not None]
+    if not known:
+        return d
+
+    x0, x1 = PAD_LEFT, width - PAD_RIGHT
+    y0, y1 = PAD_BOTTOM, height - PAD_TOP
+
+    ticks = nice_ticks(0, max(max(known), 50))
+    hi = ticks[-1]
+
+    def y_of(v):
+        return y0 + v / hi * (y1 - y0)
+
+    _value_axis(d, ticks, y_of, x0, x1)
+
+    slot = (x1 - x0) / len(values)
+    bar = min(slot * 0.6, 36)
+
+    for i, v in enumerate(values):
+        cx = x0 + slot * (i + 0.5)
+        d.add(String(cx, y0 - 10, str(i + 1), fontName=FONT, fontSize=7, fillColor=AXIS, textAnchor="middle"))
+        if v is None:
+            continue
+        top = y_of(v)
+        d.add(Rect(cx - bar / 2, y0, bar, top - y0, fillColor=aqi_color(v), strokeColor=AXIS, strokeWidth=0.3))
+        d.add(String(cx, top + 3, _tick_label(round(v)), fontName=FONT, fontSize=7,
+                     fillColor=TEXT, textAnchor="middle"))
+
+    _frame(d, x0, y0, x1, y1, title, "Reading", "AQI")
+    return d
+
+
+def pss_radar(scores, size, title="Stress Breakdown (PSS-10)"):
+    """Five-axis radar of PSS-10 sub-scale scores, each scaled to its maximum."""
+    d = Drawing(size, size)
+    cx, cy = size / 2, (size - 16) / 2
+    radius = (size - 16) / 2 - 28
+    n = len(PSS_DIMENSIONS)
+
+    def point(i, r):
+        angle = math.pi / 2 - i * 2 * math.pi / n
+        return cx + r * math.cos(angle), cy + r * math.sin(angle)
+
+    for ring in range(1, 6):
+        outline = []
+        for i in range(n):
+            outline += point(i, radius * ring / 5)
+        d.add(Polygon(outline, fillColor=None, strokeColor=GRID, strokeWidth=0.6))
+
+    for i, (_, label, _) in enumerate(PSS_DIMENSIONS):
+        x, y = point(i, radius)
+        d.add(Line(cx, cy, x, y, strokeColor=GRID, strokeWidth=0.6))
+        lx, ly = point(i, radius + 14)
+        d.add(String(lx, ly - 3, label, fontName=FONT_BOLD, fontSize=8, fillColor=AXIS, textAnchor="middle"))
+
+    shape = []
+    for i, (key, _, maximum) in enumerate(PSS_DIMENSIONS):
+        value = float(scores.get(key) or 0)
+        shape += point(i, radius * min(max(value / maximum, 0.0), 1.0))
+
+    d.add(Polygon(shape, fillColor=ROSE_FILL, strokeColor=ROSE, strokeWidth=2, strokeLineJoin=1))
+    for i in range(0, len(shape), 2):
+        d.add(Circle(shape[i], shape[i + 1], 2.6, fillColor=ROSE, strokeColor=colors.white, strokeWidth=0.6))
+
+    if title:
+        d.add(String(cx, size - 11, title, fontName=FONT_BOLD, fontSize=10, fillColor=TEXT, textAnchor="middle"))
+    return d
+
+
+def matplotlib_trend(values, title="Heart Rate Trend (Last 7 Readings)"):
+    """Raster fallback for heart_rate_trend(); returns a PNG in a BytesIO."""
+    # Imported here so the vector path never loads matplotlib
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    x_values = list(range(1, len(values) + 1))
+
+    # Use Figure() instead of plt.figure() for thread safety
+    fig = Figure(figsize=(6, 3))
+    ax = fig.add_subplot(111)
+
+    ax.plot(x_values, values, marker="o", linewidth=2, color="#f43f5e")
+    ax.fill_between(x_values, values, color="#f43f5e", alpha=0.15)
+
+    ax.set_title(title)
+    ax.set_xlabel("Reading")
+    ax.set_ylabel("BPM")
+    ax.grid(True, alpha=0.3)
+
+    png = io.BytesIO()
+    FigureCanvas(fig).print_png(png)
+    png.seek(0)
+    return png
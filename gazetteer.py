@@ -0,0 +1,152 @@
+"""
+Offline city gazetteer.
+
+Loads data/cities.csv lazily into flat arrays and answers, without any
+network access:
+- exact lookups by normalized name or alias
+- prefix searches (sorted key list + bisect)
+- nearest-city queries (implicit k-d tree over unit-sphere coordinates)
+"""
+import bisect
+import csv
+import math
+import os
+import threading
+
+import numpy as np
+
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.csv")
+EARTH_RADIUS_KM = 6371.0
+
+
+def normalize_name(name):
+    return " ".join(name.strip().lower().split())
+
+
+def _unit_vectors(lat, lon):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+class Gazetteer:
+
+    def __init__(self, path=GAZETTEER_PATH):
+        names, states, lats, lons = [], [], [], []
+        index = {}
+
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                i = len(names)
+                names.append(row["name"])
+                states.append(row["state"])
+                lats.append(float(row["lat"]))
+                lons.append(float(row["lon"]))
+
+                index.setdefault(normalize_name(row["name"]), i)
+                for alias in (row.get("aliases") or "").split(";"):
+                    if alias.strip():
+                        index.setdefault(normalize_name(alias), i)
+
+        self.names = names
+        self.states = states
+        self.lat = np.array(lats)
+        self.lon = np.array(lons)
+
+        self._index = index
+        self._keys = sorted(index)
+
+        # k-d tree stored implicitly: each index range's median is its node
+        self._points = _unit_vectors(self.lat, self.lon).tolist()
+        self._order = list(range(len(names)))
+        self._build(0, len(names), 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _build(self, lo, hi, depth):
+        if hi - lo <= 1:
+            return
+        axis = depth % 3
+        self._order[lo:hi] = sorted(self._order[lo:hi], key=lambda i: self._points[i][axis])
+        mid = (lo + hi) // 2
+        self._build(lo, mid, depth + 1)
+        self._build(mid + 1, hi, depth + 1)
+
+    def lookup(self, name):
+        """(lat, lon) for a known city name or alias, else None."""
+        i = self._index.get(normalize_name(name))
+        if i is None:
+            return None
+        return float(self.lat[i]), float(self.lon[i])
+
+    def canonical_name(self, name):
+        i = self._index.get(normalize_name(name))
+        return self.names[i] if i is not None else None
+
+    def search(self, prefix, limit=10):
+        """Canonical city names whose name or alias starts with `prefix`."""
+        prefix = normalize_name(prefix)
+        if not prefix:
+            return []
+
+        found = []
+        start = bisect.bisect_left(self._keys, prefix)
+        for key in self._keys[start:]:
+            if not key.startswith(prefix) or len(found) >= limit:
+                break
+            name = self.names[self._index[key]]
+            if name not in found:
+                found.append(name)
+        return found
+
+    def nearest(self, lat, lon):
+        """(city name, distance in km) of the closest known city."""
+        if not self.names:
+            return None
+
+        phi, lam = math.radians(lat), math.radians(lon)
+        query = (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+        best_d2, best_i = self._nearest(query, 0, len(self._order), 0, (math.inf, -1))
+
+        chord = math.sqrt(best_d2)
+        km = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+        return self.names[best_i], km
+
+    def _nearest(self, q, lo, hi, depth, best):
+        if lo >= hi:
+            return best
+
+        mid = (lo + hi) // 2
+        i = self._order[mid]
+        p = self._points[i]
+
+        d2 = (p[0] - q[0]) ** 2 + (p[1] - q[1]) ** 2 + (p[2] - q[2]) ** 2
+        if d2 < best[0]:
+            best = (d2, i)
+
+        diff = q[depth % 3] - p[depth % 3]
+        if diff < 0:
+            near, far = (lo, mid), (mid + 1, hi)
+        else:
+            near, far = (mid + 1, hi), (lo, mid)
+
+        best = self._nearest(q, near[0], near[1], depth + 1, best)
+        if diff * diff < best[0]:
+            best = self._nearest(q, far[0], far[1], depth + 1, best)
+        return best
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """Process-wide gazetteer, loaded on first use."""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer()
+    return _gazetteer
@@ -0,0 +1,423 @@
+"""
+Server-side PPG (camera pulse) analysis.
+
+Takes raw red-channel sample buffers with their timestamps, resamples them
+onto a uniform grid, detrends, band-pass filters in the frequency domain and
+estimates BPM two ways:
+- FFT peak of the windowed spectrum (parabolic interpolation between bins)
+- mean interval between systolic peaks of the filtered waveform
+A quality score (share of in-band power around the pulse and its harmonic)
+says how much to trust the result. All buffers of a batch are processed
+together as one padded 2-D array.
+
+Streaming sessions (PPGStream) run the same pipeline incrementally with
+IIR filters instead, for interim results while a measurement is running.
+"""
+import math
+import secrets
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+FS = 30.0                   # resampling rate, Hz
+BAND = (0.7, 3.5)           # pass band, Hz (42-210 BPM)
+NOISE_BAND = (0.5, 4.0)     # quality is measured against this range
+PEAK_WIDTH = 0.15           # Hz either side of the pulse counted as signal
+EDGE_SECONDS = 0.5          # filter ringing at the ends is ignored for peaks
+
+MIN_SECONDS = 5.0
+MAX_SECONDS = 120.0
+MIN_QUALITY = 0.35
+AGREE_BPM = 6.0             # FFT and peak-interval estimates must agree this well
+
+
+def resample(samples, timestamps, fs=FS):
+    """
+    Uniformly resample one buffer. `timestamps` are in milliseconds
+    (Date.now() / performance.now()); unsorted or repeated ones are tolerated.
+    """
+    x = np.asarray(samples, dtype=float)
+    t = np.asarray(timestamps, dtype=float) / 1000.0
+
+    if x.shape != t.shape or x.ndim != 1:
+        raise ValueError("samples and timestamps must be equal-length lists")
+
+    ok = np.isfinite(x) & np.isfinite(t)
+    x, t = x[ok], t[ok]
+
+    order = np.argsort(t, kind="stable")
+    t, first = np.unique(t[order], return_index=True)
+    x = x[order][first]
+
+    if len(t) < 2:
+        raise ValueError("not enough samples")
+
+    duration = min(t[-1] - t[0], MAX_SECONDS)
+    grid = t[0] + np.arange(int(duration * fs) + 1) / fs
+    return np.interp(grid, t, x)
+
+
+def _pad(signals):
+    lengths = np.array([len(s) for s in signals])
+    x = np.zeros((len(signals), lengths.max()))
+    for i, s in enumerate(signals):
+        x[i, :len(s)] = s
+    return x, lengths
+
+
+def _detrend(x, mask):
+    """Remove each row's least-squares line and scale it to unit variance."""
+    n = mask.sum(axis=1, keepdims=True)
+    t = np.arange(x.shape[1], dtype=float)
+
+    t_mean = (t * mask).sum(axis=1, keepdims=True) / n
+    x_mean = (x * mask).sum(axis=1, keepdims=True) / n
+    dt = (t - t_mean) * mask
+    slope = (dt * (x - x_mean)).sum(axis=1, keepdims=True) / (dt * dt).sum(axis=1, keepdims=True)
+
+    x = (x - x_mean - slope * dt) * mask
+    std = np.sqrt((x * x).sum(axis=1, keepdims=True) / n)
+    return x / np.where(std > 0, std, 1.0)
+
+
+def _hann(lengths, width):
+    i = np.arange(width)
+    span = np.maximum(lengths - 1, 1)[:, None]
+    w = 0.5 - 0.5 * np.cos(2 * np.pi * i / span)
+    return np.where(i < lengths[:, None], w, 0.0)
+
+
+def _band_power(power, freqs, lo, hi):
+    return (power * ((freqs >= lo) & (freqs <= hi))).sum(axis=1)
+
+
+def analyze_uniform(x, lengths, fs=FS):
+    """
+    Core estimator on already-uniform, zero-padded rows.
+    Returns a dict of per-row arrays: bpm_fft, bpm_peaks, quality.
+    """
+    n_rows, width = x.shape
+    mask = np.arange(width) < lengths[:, None]
+    x = _detrend(x, mask)
+
+    # Zero-padding to >= 8x the signal interpolates the spectrum finely
+    nfft = 1 << int(np.ceil(np.log2(max(8 * width, 1024))))
+    freqs = np.fft.rfftfreq(nfft, 1 / fs)
+    in_band = (freqs >= BAND[0]) & (freqs <= BAND[1])
+
+    # --- FFT peak ---
+    power = np.abs(np.fft.rfft(x * _hann(lengths, width), nfft)) ** 2
+    k = np.argmax(np.where(in_band, power, -1.0), axis=1)
+    rows = np.arange(n_rows)
+
+    a, b, c = power[rows, k - 1], power[rows, k], power[rows, np.minimum(k + 1, len(freqs) - 1)]
+    denom = a - 2 * b + c
+    with np.errstate(invalid="ignore", divide="ignore"):
+        shift = np.where(denom != 0, 0.5 * (a - c) / denom, 0.0)
+    f_peak = (k + np.clip(shift, -0.5, 0.5)) * fs / nfft
+
+    # --- quality: power at the pulse and its first harmonic vs. the noise band ---
+    f0 = f_peak[:, None]
+    near = (np.abs(freqs - f0) <= PEAK_WIDTH) | (np.abs(freqs - 2 * f0) <= PEAK_WIDTH)
+    total = _band_power(power, freqs, *NOISE_BAND)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        quality = np.where(total > 0, (power * near).sum(axis=1) / total, 0.0)
+
+    # --- band-pass + peak intervals ---
+    spectrum = np.fft.rfft(x, nfft)
+    spectrum[:, ~in_band] = 0
+    y = np.fft.irfft(spectrum, nfft)[:, :width] * mask
+
+    edge = int(EDGE_SECONDS * fs)
+    idx = np.arange(1, width - 1)
+    inside = (idx >= edge) & (idx < lengths[:, None] - 1 - edge)
+    threshold = 0.3 * np.sqrt((y * y).sum(axis=1) / lengths)[:, None]
+
+    mid = y[:, 1:-1]
+    peaks = (mid > y[:, :-2]) & (mid >= y[:, 2:]) & (mid > threshold) & inside
+
+    count = peaks.sum(axis=1)
+    first = np.argmax(peaks, axis=1)
+    last = peaks.shape[1] - 1 - np.argmax(peaks[:, ::-1], axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bpm_peaks = np.where(count >= 2, 60.0 * fs * (count - 1) / (last - first), np.nan)
+
+    return {
+        "bpm_fft": f_peak * 60.0,
+        "bpm_peaks": bpm_peaks,
+        "quality": np.clip(quality, 0.0, 1.0),
+    }
+
+
+def analyze_batch(buffers, fs=FS):
+    """
+    Analyze many (samples, timestamps) buffers in one vectorized pass.
+    Returns one dict per buffer: bpm, bpm_fft, bpm_peaks, quality, reliable
+    (or error, for buffers that could not be used).
+    """
+    results = [None] * len(buffers)
+    signals, slots = [], []
+
+    for i, (samples, timestamps) in enumerate(buffers):
+        try:
+            s = resample(samples, timestamps, fs)
+        except (TypeError, ValueError) as e:
+            results[i] = {"error": str(e)}
+            continue
+        if len(s) < MIN_SECONDS * fs:
+            results[i] = {"error": f"need at least {MIN_SECONDS:g} seconds of signal"}
+            continue
+        signals.append(s)
+        slots.append(i)
+
+    if signals:
+        x, lengths = _pad(signals)
+        est = analyze_uniform(x, lengths, fs)
+
+        for row, i in enumerate(slots):
+            bpm_fft = float(est["bpm_fft"][row])
+            bpm_peaks = float(est["bpm_peaks"][row])
+            quality = float(est["quality"][row])
+            agree = not np.isnan(bpm_peaks) and abs(bpm_fft - bpm_peaks) <= AGREE_BPM
+
+            results[i] = {
+                "bpm": int(round(bpm_fft)),
+                "bpm_fft": round(bpm_fft, 1),
+                "bpm_peaks": None if np.isnan(bpm_peaks) else round(bpm_peaks, 1),
+                "quality": round(quality, 2),
+                "reliable": bool(agree and quality >= MIN_QUALITY),
+            }
+
+    return results
+
+
+def analyze(samples, timestamps, fs=FS):
+    """Single-buffer convenience wrapper around analyze_batch."""
+    return analyze_batch([(samples, timestamps)], fs)[0]
+
+
+# =========================
+# STREAMING
+# =========================
+
+class Biquad:
+    """Second-order IIR section (RBJ cookbook), Direct Form I: four floats of state."""
+
+    def __init__(self, b, a):
+        self.b0, self.b1, self.b2 = (v / a[0] for v in b)
+        self.a1, self.a2 = a[1] / a[0], a[2] / a[0]
+        self.x1 = self.x2 = self.y1 = self.y2 = 0.0
+
+    @classmethod
+    def highpass(cls, f, fs, q=0.7071):
+        w = 2 * math.pi * f / fs
+        alpha = math.sin(w) / (2 * q)
+        cw = math.cos(w)
+        return cls(((1 + cw) / 2, -(1 + cw), (1 + cw) / 2), (1 + alpha, -2 * cw, 1 - alpha))
+
+    @classmethod
+    def lowpass(cls, f, fs, q=0.7071):
+        w = 2 * math.pi * f / fs
+        alpha = math.sin(w) / (2 * q)
+        cw = math.cos(w)
+        return cls(((1 - cw) / 2, 1 - cw, (1 - cw) / 2), (1 + alpha, -2 * cw, 1 - alpha))
+
+    def __call__(self, x):
+        y = (self.b0 * x + self.b1 * self.x1 + self.b2 * self.x2
+             - self.a1 * self.y1 - self.a2 * self.y2)
+        self.x2, self.x1 = self.x1, x
+        self.y2, self.y1 = self.y1, y
+        return y
+
+
+class PPGStream:
+    """
+    Incremental beat detector for one measurement session.
+    Samples may arrive in chunks of any size at irregular times; they are
+    linearly resampled to FS, band-passed with two biquads and scanned for
+    peaks above an adaptive envelope. State is constant-size: the filters,
+    a handful of scalars and the last few inter-beat intervals.
+    push() and status() are safe to call from concurrent requests.
+    """
+
+    WARMUP_SECONDS = 2.0        # let the filters settle before counting beats
+    INTERVALS_KEPT = 8
+    MAX_GAP = 2.0               # longer gaps restart the filters instead of interpolating
+    MAX_SPAN = 3600.0           # timestamps this far past the first one are rejected
+
+    def __init__(self, fs=FS):
+        self.fs = fs
+        self.lock = threading.Lock()
+        self.start_t = None
+        self.last_t = self.last_x = None
+        self.seconds = 0.0
+        self.decay = math.exp(-1.0 / (2.0 * fs))
+        self.beats = 0
+        self.intervals = deque(maxlen=self.INTERVALS_KEPT)
+        self._restart(None)
+
+    def _restart(self, t):
+        """Fresh resampler and filters from time `t`; beat history is kept."""
+        # Corners sit outside BAND so 2nd-order roll-off does not tilt
+        # the pulse against its harmonic at the ends of the range
+        self.highpass = Biquad.highpass(NOISE_BAND[0], self.fs)
+        self.lowpass = Biquad.lowpass(NOISE_BAND[1], self.fs)
+        self.grid_t = self.settle_t = t
+        self.y1 = self.y2 = 0.0
+        self.envelope = 0.0
+        self.last_beat = None
+
+    def _validate(self, samples, timestamps):
+        """Parsed (x, t seconds) pairs; ValueError for backwards or absurd timestamps."""
+        points = []
+        prev = self.last_t
+        first = self.start_t
+        for x, t in zip(samples, timestamps):
+            try:
+                x, t = float(x), float(t) / 1000.0
+            except (TypeError, ValueError):
+                raise ValueError("samples and timestamps must be numbers")
+            if not math.isfinite(t):
+                raise ValueError("timestamps must be finite")
+            if prev is not None and t < prev:
+                raise ValueError("timestamps must not go backwards")
+            if first is None:
+                first = t
+            if t - first > self.MAX_SPAN:
+                raise ValueError("timestamps span more than an hour")
+            prev = t
+            if math.isfinite(x):
+                points.append((x, t))
+        return points
+
+    def push(self, samples, timestamps):
+        """
+        Feed a chunk; timestamps in ms, non-decreasing. Raises ValueError
+        (and ignores the whole chunk) when they are not.
+        """
+        with self.lock:
+            for x, t in self._validate(samples, timestamps):
+                if self.last_t is None:
+                    self.start_t = t
+                    self._restart(t)
+                    self.last_t, self.last_x = t, x
+                    continue
+                if t == self.last_t:
+                    continue
+
+                span = t - self.last_t
+                if span > self.MAX_GAP:
+                    # Interpolating across a pause would only add noise (and
+                    # cost one filter step per 1/FS of claimed time)
+                    self._restart(t)
+                    self.last_t, self.last_x = t, x
+                    continue
+
+                # Emit every grid point between the previous sample and this one
+                while self.grid_t <= t:
+                    v = self.last_x + (x - self.last_x) * (self.grid_t - self.last_t) / span
+                    self._step(self.grid_t, v)
+                    self.grid_t += 1.0 / self.fs
+
+                self.seconds += span
+                self.last_t, self.last_x = t, x
+
+    def _step(self, t, v):
+        y = self.lowpass(self.highpass(v))
+        # Decaying peak envelope (~2 s); beats must reach half of it, which
+        # skips the smaller dicrotic bump
+        self.envelope = max(abs(y), self.envelope * self.decay)
+
+        # y1 is a local maximum: time it at the previous grid point
+        is_peak = self.y1 > self.y2 and self.y1 >= y and self.y1 > 0.5 * self.envelope
+        self.y2, self.y1 = self.y1, y
+
+        peak_t = t - 1.0 / self.fs
+        if not is_peak or peak_t - self.settle_t < self.WARMUP_SECONDS:
+            return
+        if self.last_beat is not None and peak_t - self.last_beat < 1 / BAND[1]:
+            return
+
+        if self.last_beat is not None:
+            interval = peak_t - self.last_beat
+            if 1 / BAND[1] <= interval <= 1 / BAND[0]:
+                self.intervals.append(interval)
+        self.last_beat = peak_t
+        self.beats += 1
+
+    def status(self):
+        """Interim estimate: bpm (median interval), quality (interval regularity)."""
+        with self.lock:
+            return self._status()
+
+    def _status(self):
+        seconds = self.seconds
+
+        if len(self.intervals) < 3:
+            return {"bpm": None, "quality": 0.0, "beats": self.beats, "seconds": round(seconds, 1)}
+
+        ibi = np.array(self.intervals)
+        cv = ibi.std() / ibi.mean()
+        return {
+            "bpm": int(round(60.0 / np.median(ibi))),
+            "quality": round(float(max(0.0, 1.0 - 3 * cv)), 2),
+            "beats": self.beats,
+            "seconds": round(seconds, 1),
+        }
+
+
+class StreamLimitError(Exception):
+    """No room for another streaming session."""
+
+
+class StreamRegistry:
+    """
+    Live PPGStream sessions for this process, keyed by an opaque id.
+    Sessions idle for `idle_timeout` seconds are evicted; when full, idle
+    ones are evicted first and further sessions are refused. Each session's
+    PPGStream carries its own lock, so chunks for one session are applied
+    one at a time without serializing other sessions.
+    """
+
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = {}      # id -> [owner, stream, last_seen]
+        self.lock = threading.Lock()
+
+    def _evict_idle(self, now):
+        expired = [sid for sid, (_, _, seen) in self.sessions.items() if now - seen > self.idle_timeout]
+        for sid in expired:
+            del self.sessions[sid]
+
+    def open(self, owner):
+        now = time.monotonic()
+        with self.lock:
+            self._evict_idle(now)
+            if len(self.sessions) >= self.max_sessions:
+                raise StreamLimitError("too many active measurement sessions")
+            sid = secrets.token_urlsafe(12)
+            self.sessions[sid] = [owner, PPGStream(), now]
+            return sid
+
+    def get(self, sid, owner):
+        """The caller's stream, touched as active, or None."""
+        now = time.monotonic()
+        with self.lock:
+            self._evict_idle(now)
+            entry = self.sessions.get(sid)
+            if entry is None or entry[0] != owner:
+                return None
+            entry[2] = now
+            return entry[1]
+
+    def close(self, sid, owner):
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None or entry[0] != owner:
+                return None
+            del self.sessions[sid]
+            return entry[1]
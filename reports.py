@@ -0,0 +1,573 @@
+"""
+PDF health reports.
+
+render_report_pdf() builds the whole report in memory and returns the PDF
+bytes, so callers can stream it straight back without touching the
+filesystem. Charts are reportlab vector drawings (see charts.py); matplotlib
+is only loaded when REPORT_CHART_BACKEND=matplotlib.
+
+ReportQueue runs those renders in a small process pool so the CPU-bound
+layout never holds a web worker's GIL, and keeps finished PDFs in a
+ReportCache keyed by a hash of the normalized payload, so identical
+reports are rendered once.
+"""
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from reportlab.graphics import renderPDF
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.lib import colors
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Table, TableStyle, Paragraph
+from reportlab.lib.styles import getSampleStyleSheet
+
+import charts
+
+
+# "vector" draws charts as PDF paths; "matplotlib" embeds a PNG instead
+CHART_BACKEND = os.getenv("REPORT_CHART_BACKEND", "vector")
+CHART_HEIGHT = 170
+
+# Bump whenever the layout changes so cached PDFs are not served stale
+TEMPLATE_VERSION = 3
+
+REPORT_FIELDS = ("name", "age", "city", "timestamp", "bpm", "impactCategory", "aqi", "pm25", "pm10")
+HISTORY_FIELDS = ("bpm", "time", "aqi")
+
+
+def _clean(value):
+    return value.strip() if isinstance(value, str) else value
+
+
+def normalize_payload(data):
+    """
+    The part of a /generate-pdf payload the report actually uses, with
+    strings trimmed. Rendering from this keeps the cache key and the PDF
+    in step: extra fields or whitespace cannot produce a different report.
+    """
+    report = {field: _clean(data.get(field)) for field in REPORT_FIELDS if data.get(field) is not None}
+
+    history = data.get("history")
+    if isinstance(history, list):
+        report["history"] = [
+            {field: _clean(h.get(field)) for field in HISTORY_FIELDS if h.get(field) is not None}
+            for h in history if isinstance(h, dict)
+        ]
+
+    stress = data.get("stress")
+    if isinstance(stress, dict):
+        report["stress"] = {key: stress.get(key) for key, _, _ in charts.PSS_DIMENSIONS}
+
+    return report
+
+
+def report_key(report):
+    """Content hash of a normalized payload plus the template version and chart backend."""
+    canonical = json.dumps(
+        [TEMPLATE_VERSION, CHART_BACKEND, report],
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def render_report_pdf(data):
+    """
+    Render the heart-rate/AQI report for a /generate-pdf payload
+    (name, age, city, timestamp, bpm, impactCategory, aqi, pm25, pm10,
+    history, optional stress sub-scores) and return it as PDF bytes.
+    """
+    history = data.get("history", [])
+    bpm_values = [h.get("bpm", 0) for h in history]
+    aqi_values = [h.get("aqi") if isinstance(h.get("aqi"), (int, float)) else None for h in history]
+    stress = data.get("stress") if isinstance(data.get("stress"), dict) else None
+
+    # ==================================================
+    # 📄 CREATE PDF
+    # ==================================================
+    out = io.BytesIO()
+    c = canvas.Canvas(out, pagesize=A4)
+    width, height = A4
+    
+    # Margins & Dimensions
+    BOTTOM_MARGIN = 2 * cm
+    LEFT_MARGIN = 2 * cm
+    RIGHT_MARGIN = 2 * cm
+    CONTENT_WIDTH = width - LEFT_MARGIN - RIGHT_MARGIN
+
+    # --- Helper to check page space ---
+    def check_page_break(current_y, needed_height):
+        if current_y - needed_height < BOTTOM_MARGIN:
+            c.showPage()
+            return height - 50 # Reset Y to top
+        return current_y
+
+    # ---------- HEADER ----------
+    c.setFillColorRGB(0.96, 0.26, 0.39) # HridyaCare Pink
+    c.rect(0, height - 70, width, 70, fill=1)
+    c.setFillColor(colors.white)
+    c.setFont("Helvetica-Bold", 22)
+    c.drawCentredString(width / 2, height - 45, "HridyaCare Health Report")
+
+    y = height - 100
+    c.setFillColor(colors.black)
+
+    # ---------- USER INFO ----------
+    c.setFont("Helvetica", 12)
+    c.drawString(LEFT_MARGIN, y, f"Username: {data.get('name', 'User')}")
+    c.drawRightString(width - RIGHT_MARGIN, y, f"Date: {data.get('timestamp')}")
+    y -= 18
+
+    c.drawString(LEFT_MARGIN, y, f"Age: {data.get('age')}")
+    c.drawRightString(width - RIGHT_MARGIN, y, f"City: {data.get('city')}")
+    y -= 30
+
+    # ---------- HEART RATE CARD ----------
+    c.setFillColorRGB(0.95, 0.96, 0.98)
+    c.roundRect(LEFT_MARGIN, y - 80, CONTENT_WIDTH, 80, 12, fill=1)
+    c.setFillColor(colors.black)
+
+    c.setFont("Helvetica-Bold", 20)
+    c.drawCentredString(width / 2, y - 35, f"{data.get('bpm')} BPM")
+
+    c.setFont("Helvetica", 12)
+    c.drawCentredString(width / 2, y - 60, f"Impact: {data.get('impactCategory')}")
+    y -= 100 # Adjusted spacing
+
+    # ---------- AQI DETAILS ----------
+    c.setFillColorRGB(0.97, 0.97, 0.97)
+    c.roundRect(LEFT_MARGIN, y - 70, CONTENT_WIDTH, 70, 10, fill=1)
+    c.setFillColor(colors.black)
+
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(LEFT_MARGIN + 10, y - 28, f"AQI: {data.get('aqi', '--')} (US EPA)")
+
+    c.setFont("Helvetica", 11)
+    c.drawString(LEFT_MARGIN + 10, y - 48, f"PM2.5: {data.get('pm25', '--')} µg/m³")
+    c.drawRightString(width - RIGHT_MARGIN - 10, y - 48, f"PM10: {data.get('pm10', '--')} µg/m³")
+
+    y -= 90
+
+    # ---------- HEART RATE TREND ----------
+    if history:
+        y = check_page_break(y, CHART_HEIGHT + 10)
+
+        if CHART_BACKEND == "matplotlib":
+            c.drawImage(
+                ImageReader(charts.matplotlib_trend(bpm_values)),
+                LEFT_MARGIN,
+                y - CHART_HEIGHT,
+                width=CONTENT_WIDTH,
+                height=CHART_HEIGHT,
+                preserveAspectRatio=True
+            )
+        else:
+            renderPDF.draw(charts.heart_rate_trend(bpm_values, CONTENT_WIDTH, CHART_HEIGHT),
+                           c, LEFT_MARGIN, y - CHART_HEIGHT)
+        y -= CHART_HEIGHT + 30
+
+    # ---------- AQI PER READING ----------
+    if any(v is not None for v in aqi_values):
+        y = check_page_break(y, CHART_HEIGHT + 10)
+        renderPDF.draw(charts.aqi_bars(aqi_values, CONTENT_WIDTH, CHART_HEIGHT),
+                       c, LEFT_MARGIN, y - CHART_HEIGHT)
+        y -= CHART_HEIGHT + 30
+
+    # ---------- STRESS RADAR ----------
+    if stress:
+        size = 220
+        y = check_page_break(y, size + 10)
+        renderPDF.draw(charts.pss_radar(stress, size), c, LEFT_MARGIN + (CONTENT_WIDTH - size) / 2, y - size)
+        y -= size + 20
+
+    # ---------- HEART RATE TABLE ----------
+    if history:
+        # Check space for Title + minimal table
+        y = check_page_break(y, 100)
+        
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(LEFT_MARGIN, y, "Last 7 Heart Rate Readings")
+        y -= 20
+
+        hr_table_data = [["#", "BPM", "Time"]]
+        # Limit history to prevent huge tables if needed, or paginate inside
+        # For now, we take the last 7 strictly
+        for i, h in enumerate(history[:7][::-1], 1):
+            hr_table_data.append([str(i), str(h.get("bpm", "--")), h.get("time", "--")])
+
+        hr_table = Table(hr_table_data, colWidths=[2 * cm, 3 * cm, CONTENT_WIDTH - 5 * cm])
+        hr_table.setStyle(TableStyle([
+            ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+            ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+            ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+            ("FONT", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ]))
+
+        _, table_height = hr_table.wrap(CONTENT_WIDTH, height)
+        
+        # Check if table fits, if not new page
+        y = check_page_break(y, table_height)
+        
+        hr_table.drawOn(c, LEFT_MARGIN, y - table_height)
+        y -= (table_height + 30)
+
+    # ---------- AQI REFERENCE TABLE ----------
+    # Check space for Title + AQI Table (approx 150-200 units)
+    y = check_page_break(y, 200)
+
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(LEFT_MARGIN, y, "AQI Reference (US EPA Scale)")
+    y -= 20
+
+    styles = getSampleStyleSheet()
+    cell_style = styles["BodyText"]
+    cell_style.fontSize = 9
+    cell_style.leading = 11
+
+    aqi_table_data = [
+        [Paragraph("<b>AQI Range</b>", cell_style),
+         Paragraph("<b>Category</b>", cell_style),
+         Paragraph("<b>Health Meaning</b>", cell_style)],
+        ["0–50", "Good", "Air quality is satisfactory"],
+        ["51–100", "Moderate", "Some pollutants may affect sensitive people"],
+        ["101–150", "Sensitive Groups", "Lung/heart disease risks"],
+        ["151–200", "Unhealthy", "Everyone may experience effects"],
+        ["201–300", "Very Unhealthy", "Health alert: increased risk"],
+        ["301+", "Hazardous", "Emergency conditions"],
+    ]
+
+    aqi_table = Table(aqi_table_data, colWidths=[2.5 * cm, 4 * cm, CONTENT_WIDTH - 6.5 * cm])
+    aqi_table.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#fee2e2")),
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.grey),
+        ("ALIGN", (0, 0), (-1, -1), "LEFT"),
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+        ("PADDING", (0,0), (-1,-1), 6),
+    ]))
+
+    _, aqi_height = aqi_table.wrap(CONTENT_WIDTH, height)
+    
+    # We already checked for space above, but good double check
+    y = check_page_break(y, aqi_height)
+    
+    aqi_table.drawOn(c, LEFT_MARGIN, y - aqi_height)
+    y -= (aqi_height + 20)
+
+    # ---------- FOOTER / DISCLAIMER ----------
+    y = check_page_break(y, 30)
+    c.setFont("Helvetica-Oblique", 10)
+    c.setFillColor(colors.grey)
+    c.drawString(LEFT_MARGIN, y, "This report provides wellness insights and is not a medical diagnosis.")
+
+    c.showPage()
+    c.save()
+
+    return out.getvalue()
+
+
+# =========================
+# RENDER QUEUE
+# =========================
+class QueueFullError(Exception):
+    """Too many reports are already queued or rendering."""
+
+
+class ReportCache:
+    """Rendered PDFs by report_key(), least recently used evicted past `max_bytes`."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()    # key -> pdf bytes
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            pdf = self.entries.get(key)
+            if pdf is not None:
+                self.entries.move_to_end(key)
+            return pdf
+
+    def put(self, key, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = pdf
+            self.size += len(pdf)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class ReportQueue:
+    """
+    Report jobs for this process. A job id is derived from the owner and
+    the report's content key, so re-submitting the same report returns the
+    same job (and download URL) instead of rendering it again.
+    At most `max_pending` jobs may be queued or rendering at once; further
+    submissions are refused. Finished jobs keep their PDF (or error) for
+    `result_ttl` seconds so the owner can fetch it; PDFs outlive their jobs
+    in `cache`, shared by every owner.
+    """
+
+    SLOT_WAIT = 30.0        # render_many(): longest wait for a slot with nothing in flight
+
+    def __init__(self, workers, max_pending, result_ttl, start_method="forkserver", cache=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.start_method = start_method
+        self.cache = cache
+        self.pool = None
+        self.jobs = {}          # id -> [owner, future, finished_at, key]
+        self.streaming = 0      # render_many() renders in flight
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        if self.pool is None:
+            # Workers must not be forked from the (by now multi-threaded) web
+            # process; forkserver forks them from a clean single-threaded
+            # server that has already imported this module
+            context = multiprocessing.get_context(self.start_method)
+            if self.start_method == "forkserver":
+                context.set_forkserver_preload(["reports"])
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self.pool
+
+    def _evict_expired(self, now):
+        expired = [
+            jid for jid, (_, _, finished, _) in self.jobs.items()
+            if finished is not None and now - finished > self.result_ttl
+        ]
+        for jid in expired:
+            del self.jobs[jid]
+
+    def _finished(self, entry):
+        def stamp(future):
+            entry[2] = time.monotonic()
+            if self.cache is not None and future.exception() is None:
+                self.cache.put(entry[3], future.result())
+        return stamp
+
+    def _pending(self):
+        jobs = sum(1 for _, future, _, _ in self.jobs.values() if not future.done())
+        return jobs + self.streaming
+
+    def has_room(self, n):
+        """Whether `n` more renders fit under max_pending right now (advisory)."""
+        with self.lock:
+            self._evict_expired(time.monotonic())
+            return self._pending() + n <= self.max_pending
+
+    def _claim(self):
+        """Take one render_many() slot under max_pending; False when full."""
+        with self.lock:
+            self._evict_expired(time.monotonic())
+            if self._pending() >= self.max_pending:
+                return False
+            self.streaming += 1
+            return True
+
+    def _release(self, _future=None):
+        with self.lock:
+            self.streaming -= 1
+
+    def submit(self, owner, data):
+        """Queue a render of `data`; returns the job id."""
+        report = normalize_payload(data)
+        key = report_key(report)
+        jid = hashlib.sha256(f"{owner}:{key}".encode()).hexdigest()[:24]
+        now = time.monotonic()
+
+        with self.lock:
+            self._evict_expired(now)
+
+            entry = self.jobs.get(jid)
+            if entry is not None and not (entry[1].done() and entry[1].exception() is not None):
+                # Same report already queued or finished for this owner
+                if entry[2] is not None:
+                    entry[2] = now
+                return jid
+
+            pdf = self.cache.get(key) if self.cache is not None else None
+            if pdf is not None:
+                future = Future()
+                future.set_result(pdf)
+                self.jobs[jid] = [owner, future, now, key]
+                return jid
+
+            if self._pending() >= self.max_pending:
+                raise QueueFullError("report queue is full")
+
+            future = self._render(report)
+            entry = self.jobs[jid] = [owner, future, None, key]
+
+        future.add_done_callback(self._finished(entry))
+        return jid
+
+    def _render(self, report):
+        try:
+            return self._pool().submit(render_report_pdf, report)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM); reap the dead pool's processes and
+            # start a fresh one for new jobs
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            return self._pool().submit(render_report_pdf, report)
+
+    def render_many(self, items, window):
+        """
+        Render (name, payload) pairs in the pool, yielding (name, pdf bytes
+        or None on failure) in completion order. At most `window` renders are
+        in flight, so memory stays flat however many reports there are.
+        Each render claims a slot under max_pending before it is submitted,
+        like queued jobs. While the queue is full we wait for one of ours to
+        finish, or with none in flight up to SLOT_WAIT seconds for any slot;
+        a report that still gets none is yielded as failed. Cached reports
+        are yielded without rendering.
+        """
+        in_flight = {}      # future -> (name, key)
+
+        def finished(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                name, key = in_flight.pop(future)
+                try:
+                    pdf = future.result()
+                except Exception as e:
+                    print(f"Report render failed for {name}: {e}")
+                    yield name, None
+                    continue
+                if self.cache is not None:
+                    self.cache.put(key, pdf)
+                yield name, pdf
+
+        try:
+            for name, data in items:
+                report = normalize_payload(data)
+                key = report_key(report)
+
+                pdf = self.cache.get(key) if self.cache is not None else None
+                if pdf is not None:
+                    yield name, pdf
+                    continue
+
+                while len(in_flight) >= window:
+                    yield from finished(FIRST_COMPLETED)
+
+                claimed = self._claim()
+                waited = 0.0
+                while not claimed:
+                    if in_flight:
+                        yield from finished(FIRST_COMPLETED)
+                    elif waited >= self.SLOT_WAIT:
+                        break
+                    else:
+                        time.sleep(0.25)
+                        waited += 0.25
+                    claimed = self._claim()
+
+                if not claimed:
+                    print(f"Report render skipped for {name}: queue full")
+                    yield name, None
+                    continue
+
+                try:
+                    with self.lock:
+                        future = self._render(report)
+                except Exception:
+                    self._release()
+                    raise
+                in_flight[future] = (name, key)
+                future.add_done_callback(self._release)
+
+            while in_flight:
+                yield from finished(FIRST_COMPLETED)
+        finally:
+            # The consumer went away (e.g. client disconnect); drop queued work
+            for future in in_flight:
+                future.cancel()
+
+    def _entry(self, jid, owner):
+        with self.lock:
+            self._evict_expired(time.monotonic())
+            entry = self.jobs.get(jid)
+            if entry is None or entry[0] != owner:
+                return None
+            return entry
+
+    def status(self, jid, owner):
+        """queued | rendering | done | failed, or None for an unknown job."""
+        entry = self._entry(jid, owner)
+        if entry is None:
+            return None
+        future = entry[1]
+        if not future.done():
+            return "rendering" if future.running() else "queued"
+        return "failed" if future.exception() is not None else "done"
+
+    def result(self, jid, owner, timeout=0):
+        """
+        (status, pdf bytes or None, content key), waiting up to `timeout`
+        seconds for the render to finish. Status is None for an unknown job.
+        """
+        entry = self._entry(jid, owner)
+        if entry is None:
+            return None, None, None
+        future, key = entry[1], entry[3]
+        try:
+            return "done", future.result(timeout=timeout), key
+        except FutureTimeout:
+            return ("rendering" if future.running() else "queued"), None, key
+        except Exception as e:
+            print(f"Report render failed: {e}")
+            return "failed", None, key
+
+
+# =========================
+# ZIP STREAMING
+# =========================
+class _ChunkSink(io.RawIOBase):
+    """Unseekable write target that hands back whatever was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(files):
+    """
+    Yield a ZIP archive of (name, bytes) pairs chunk by chunk, as each file
+    arrives, holding no more than one file in memory.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain()
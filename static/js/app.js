@@ -36,25 +36,25 @@ let userData = {
 ========================= */
 async function fetchRealAQIByCity(city) {
   try {
-    const res = await fetch(`/api/aqi?city=${encodeURIComponent(city)}`);
-    const json = await res.json(); 
+    // The family page preloads every member city via /api/aqi/batch
+    let json = (window.HCARE_AQI_BY_CITY || {})[city];
+    let ok = true;
+
+    if (!json || json.error) {
+      const res = await fetch(`/api/aqi?city=${encodeURIComponent(city)}`);
+      json = await res.json();
+      ok = res.ok;
+    }
 
-    if (!res.ok || json.error) {
+    if (!ok || json.error) {
         console.warn("AQI Error:", json.error);
         return null;
     }
 
-    let finalAQI = json.aqi;
-    const pm25 = json.pm25;
-
-    // Recalculate if AQI looks suspicious but we have PM2.5
-    if (pm25 !== null && (finalAQI < 20 || finalAQI === pm25)) {
-        finalAQI = calculateUS_AQI(pm25);
-    }
-
+    // AQI is already computed server-side from the US EPA breakpoints
 const result = {
-  aqi: finalAQI,
-  pm25: pm25 || 0,
+  aqi: json.aqi,
+  pm25: json.pm25 || 0,
   pm10: json.pm10 || 0
 };
 
@@ -75,17 +75,7 @@ return result;
   }
 }
 
-function calculateUS_AQI(pm25) {
-    if (pm25 == null || pm25 < 0) return 0;
-    let c = parseFloat(pm25);
-    if (c <= 12.0) return Math.round(((50 - 0) / (12.0 - 0)) * (c - 0) + 0);
-    if (c <= 35.4) return Math.round(((100 - 51) / (35.4 - 12.1)) * (c - 12.1) + 51);
-    if (c <= 55.4) return Math.round(((150 - 101) / (55.4 - 35.5)) * (c - 35.5) + 101);
-    if (c <= 150.4) return Math.round(((200 - 151) / (150.4 - 55.5)) * (c - 55.5) + 151);
-    if (c <= 250.4) return Math.round(((300 - 201) / (250.4 - 150.5)) * (c - 150.5) + 201);
-    if (c <= 350.4) return Math.round(((400 - 301) / (350.4 - 250.5)) * (c - 250.5) + 301);
-    return Math.round(((500 - 401) / (500.4 - 350.5)) * (c - 350.5) + 401);
-}
+window.fetchRealAQIByCity = fetchRealAQIByCity;
 
 /* =========================
    MAIN APP LOGIC
@@ -407,7 +397,7 @@ saveHeartRateToBackend(impactCategory, "Normal");
 
     // ... fetch call ...
 
-    fetch(`/api/heart-rate/last-7?member_id=${memberId || ''}`)
+    fetch(`/api/heart-rate/last-7?member_id=${memberId || ''}&tz=${encodeURIComponent(Intl.DateTimeFormat().resolvedOptions().timeZone)}`)
         .then(res => res.json())
         .then(history => {
             const box = document.getElementById("personal-baseline-box");
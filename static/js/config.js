@@ -2,5 +2,13 @@ export const CONFIG = {
     DURATION: 30,
     STABILIZE_MS: 2000,
     RING_LENGTH: 2 * Math.PI * 90,
-    FPS: 30 
+    FPS: 30,
+    // Send the raw samples to /api/ppg/analyze and prefer its BPM when reliable
+    SERVER_PPG: true,
+    // Stream samples to /ws/ppg (or /api/ppg/stream) for a live pulse while measuring
+    STREAM_PPG: true,
+    STREAM_CHUNK_MS: 500,
+    STREAM_FINAL_MS: 3000,
+    // Streamed estimates below this interval-regularity score are not shown or used
+    STREAM_MIN_QUALITY: 0.5
 };  
\ No newline at end of file
@@ -12,6 +12,151 @@ let isAboveMean = false;
 let animationFrameId;
 let mediaStream = null; // Store stream reference
 let scrollIndex = 0;
+let rawSamples = [];   // full-length copy of the signal for server analysis
+let rawTimes = [];
+let liveBpm = null;    // interim estimate pushed back by the streaming session
+
+
+// Streams samples to the server while measuring: over /ws/ppg, or as chunked
+// POSTs to /api/ppg/stream when the socket cannot open. Any failure just ends
+// the stream; the batch upload in finishExam still runs.
+const PulseStream = {
+    ws: null,
+    connecting: null,
+    sid: null,
+    samples: [],
+    times: [],
+    lastSent: 0,
+    pending: Promise.resolve(),
+    onFinal: null,
+    closed: true,
+
+    open() {
+        this.close();
+        if (!CONFIG.STREAM_PPG) return;
+
+        this.closed = false;
+        this.samples = [];
+        this.times = [];
+        this.lastSent = Date.now();
+        liveBpm = null;
+
+        try {
+            const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+            const ws = new WebSocket(`${scheme}://${location.host}/ws/ppg`);
+            this.connecting = ws;
+            ws.onopen = () => {
+                if (this.connecting !== ws) return ws.close();
+                this.connecting = null;
+                this.ws = ws;
+            };
+            ws.onmessage = (e) => { try { this.receive(JSON.parse(e.data)); } catch (err) {} };
+            ws.onclose = () => {
+                if (this.connecting === ws) {
+                    // Never opened (no WebSocket support server-side): use HTTP
+                    this.connecting = null;
+                    this.openHttp();
+                } else if (this.ws === ws) {
+                    this.ws = null;
+                    if (this.onFinal) this.onFinal(null);
+                }
+            };
+        } catch (e) {
+            this.openHttp();
+        }
+    },
+
+    async openHttp() {
+        try {
+            const res = await fetch('/api/ppg/stream', { method: 'POST' });
+            if (!res.ok) return;
+            const sid = (await res.json()).session;
+            if (this.closed) fetch(`/api/ppg/stream/${sid}`, { method: 'DELETE' }).catch(() => {});
+            else this.sid = sid;
+        } catch (e) {}
+    },
+
+    add(val, time) {
+        if (this.closed) return;
+        this.samples.push(val);
+        this.times.push(time);
+        if (time - this.lastSent >= CONFIG.STREAM_CHUNK_MS) this.flush(false);
+    },
+
+    flush(done) {
+        // Held back until a transport is up (at 30 fps a whole measurement
+        // stays well inside the server's per-chunk limit)
+        if (!this.ws && !this.sid) return;
+
+        const chunk = { samples: this.samples, timestamps: this.times };
+        if (done) chunk.done = true;
+        this.samples = [];
+        this.times = [];
+        this.lastSent = Date.now();
+
+        if (this.ws) {
+            this.ws.send(JSON.stringify(chunk));
+            return;
+        }
+
+        // One chunk at a time so timestamps reach the server in order
+        const sid = this.sid;
+        this.pending = this.pending
+            .then(() => fetch(`/api/ppg/stream/${sid}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(chunk)
+            }))
+            .then(res => res.ok ? res.json() : null)
+            .catch(() => null)
+            .then(status => {
+                if (status) return this.receive(status);
+                this.sid = null;
+                if (this.onFinal) this.onFinal(null);
+            });
+    },
+
+    receive(status) {
+        if (status.final) {
+            this.sid = null;
+            if (this.onFinal) this.onFinal(status);
+        } else if (status.bpm && status.quality >= CONFIG.STREAM_MIN_QUALITY) {
+            liveBpm = status.bpm;
+        }
+    },
+
+    // Resolves with the session's final {bpm, quality, ...}, or null
+    finish() {
+        return new Promise(resolve => {
+            if (this.closed || (!this.ws && !this.sid)) {
+                this.close();
+                return resolve(null);
+            }
+            const timer = setTimeout(() => this.onFinal && this.onFinal(null), CONFIG.STREAM_FINAL_MS);
+            this.onFinal = (status) => {
+                clearTimeout(timer);
+                this.onFinal = null;
+                this.close();
+                resolve(status);
+            };
+            this.flush(true);
+        });
+    },
+
+    close() {
+        this.closed = true;
+        this.connecting = null;
+        if (this.ws) {
+            const ws = this.ws;
+            this.ws = null;
+            try { ws.close(); } catch (e) {}
+        }
+        if (this.sid) {
+            fetch(`/api/ppg/stream/${this.sid}`, { method: 'DELETE' }).catch(() => {});
+            this.sid = null;
+        }
+    }
+};
 
 
 export const Sensor = {
@@ -118,6 +263,9 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
             const val = -r; 
             buffer.push(val); 
             if(buffer.length > 100) buffer.shift();
+            rawSamples.push(val);
+            rawTimes.push(now);
+            PulseStream.add(val, now);
 
             this.drawGraph(); 
             this.detectBeat(val, now);
@@ -151,6 +299,7 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
         ctx.clearRect(0, 0, canvas.width, canvas.height);
         buffer = [];
         dynamicMean = 0;
+        PulseStream.close();
     }
 
  
@@ -171,6 +320,9 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
         startTime = Date.now();
         beatTimes = [];
         buffer = [];
+        rawSamples = [];
+        rawTimes = [];
+        PulseStream.open();
 
         document.querySelector('.graph-container')
             .classList.add('full-width');
@@ -226,7 +378,22 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
         ctx.stroke();
     },
 
-    finishExam(onComplete) {
+    async analyzeOnServer(localBpm) {
+        try {
+            const res = await fetch('/api/ppg/analyze', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ samples: rawSamples, timestamps: rawTimes })
+            });
+            if (!res.ok) return localBpm;
+            const json = await res.json();
+            return json.reliable ? json.bpm : localBpm;
+        } catch (e) {
+            return localBpm;
+        }
+    },
+
+    async finishExam(onComplete) {
         cancelAnimationFrame(animationFrameId);
         let bpm = 0;
         if (beatTimes.length >= 3) {
@@ -243,6 +410,16 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
 
         this.stopCamera();
 
+        const streamed = await PulseStream.finish();
+        if (streamed && streamed.bpm && streamed.quality >= CONFIG.STREAM_MIN_QUALITY) {
+            bpm = streamed.bpm;
+        }
+
+        if (CONFIG.SERVER_PPG && rawSamples.length) {
+            updateMeasuringUI(95, "final");
+            bpm = await this.analyzeOnServer(bpm);
+        }
+
        if (bpm > 40 && bpm < 220) {
     UI.setRingProgress(1, "var(--success)", CONFIG.RING_LENGTH);
     UI.updateMessage("Calculation Complete", "var(--text-muted)");
@@ -321,6 +498,7 @@ UI.setRingProgress(measuringProgress, "var(--primary)", CONFIG.RING_LENGTH);
     reset() {
         state = 'IDLE';
         cancelAnimationFrame(animationFrameId);
+        PulseStream.close();
         this.stopCamera(); 
         
     }
@@ -338,7 +516,7 @@ function updateMeasuringUI(percent, phase) {
     if (phase === "measuring") {
         document.getElementById('line-1').innerText = "Measuring pulse";
         document.getElementById('line-2').innerText = "Analyzing blood flow";
-        document.getElementById('line-3').innerText = "Please stay still";
+        document.getElementById('line-3').innerText = liveBpm ? `Pulse ~${liveBpm} BPM` : "Please stay still";
     }
 
     if (phase === "final") {
@@ -4,20 +4,6 @@
 window.__CARDIOSENSE_REPORT__ = null;
 let smoothProgress = 0;
 
-// ✅ ADD THIS HELPER FUNCTION AT THE TOP
-function calculateUS_AQI(pm25) {
-    if (pm25 == null || pm25 < 0) return "--";
-    let c = parseFloat(pm25);
-    // US EPA AQI Calculation Formula (PM2.5)
-    if (c <= 12.0) return Math.round(((50 - 0) / (12.0 - 0)) * (c - 0) + 0);
-    if (c <= 35.4) return Math.round(((100 - 51) / (35.4 - 12.1)) * (c - 12.1) + 51);
-    if (c <= 55.4) return Math.round(((150 - 101) / (55.4 - 35.5)) * (c - 35.5) + 101);
-    if (c <= 150.4) return Math.round(((200 - 151) / (150.4 - 55.5)) * (c - 55.5) + 151);
-    if (c <= 250.4) return Math.round(((300 - 201) / (250.4 - 150.5)) * (c - 150.5) + 201);
-    if (c <= 350.4) return Math.round(((400 - 301) / (350.4 - 250.5)) * (c - 250.5) + 301);
-    return Math.round(((500 - 401) / (500.4 - 350.5)) * (c - 350.5) + 401);
-}
-
 export const UI = {
 
     showStep(stepId) {
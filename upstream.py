@@ -0,0 +1,157 @@
+"""
+Shared HTTP client for outbound API calls (Nominatim, WAQI, ...).
+
+One keep-alive connection pool per host, separate connect/read timeouts,
+jittered retries inside an overall deadline, and a per-host circuit breaker
+that fails fast while an upstream is down so callers can serve cached data.
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 5))
+DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", 8))
+RETRIES = int(os.getenv("UPSTREAM_RETRIES", 2))
+POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 32))
+
+BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", 30))
+
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 2.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """An outbound call failed (network error, bad status or bad body)."""
+
+
+class CircuitOpenError(UpstreamError):
+    """The host's circuit is open; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failed calls.
+    After `reset_timeout` seconds a single probe call is let through
+    (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+_session = requests.Session()
+_session.headers["User-Agent"] = "HridyaCare/1.0"
+_adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE, max_retries=0)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+        return breaker
+
+
+def get_json(url, params=None, headers=None, retries=RETRIES, deadline=DEADLINE):
+    """
+    GET `url` and return the decoded JSON body.
+    Raises CircuitOpenError without touching the network while the host is
+    marked down, and UpstreamError once retries or the deadline run out.
+    """
+    host = urlsplit(url).hostname
+    breaker = breaker_for(host)
+
+    if not breaker.allow():
+        raise CircuitOpenError(f"{host} is unavailable")
+
+    started = time.monotonic()
+    last_error = None
+    outcome = None      # "success" once the host answered, else a failure
+
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                # Full jitter keeps retrying workers from stampeding together
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+            remaining = deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+
+            try:
+                resp = _session.get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=(min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining))
+                )
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                last_error = e
+                continue
+            except requests.RequestException as e:
+                # Redirect loops, undecodable bodies, ...: not worth retrying
+                raise UpstreamError(f"{host} request failed: {e}")
+
+            if resp.status_code in RETRY_STATUSES:
+                last_error = UpstreamError(f"{host} returned {resp.status_code}")
+                continue
+
+            # The host answered, so it is up even if this request was bad
+            outcome = "success"
+
+            if resp.status_code >= 400:
+                raise UpstreamError(f"{host} returned {resp.status_code}")
+
+            try:
+                return resp.json()
+            except ValueError:
+                raise UpstreamError(f"{host} returned invalid JSON")
+
+        raise UpstreamError(f"{host} request failed: {last_error or 'deadline exceeded'}")
+    finally:
+        # Always settle the breaker, so a half-open probe can never stay open
+        if outcome == "success":
+            breaker.record_success()
+        else:
+            breaker.record_failure()